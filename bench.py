@@ -0,0 +1,1142 @@
+"""Нагрузочный тест бота без внешних сервисов.
+
+Поток обновлений Telegram (записанный JSONL-файл или синтетический) прогоняется
+через настоящие обработчики main.py. Telegram Bot API, Ollama и Stable Diffusion
+заменяются локальными HTTP-заглушками с настраиваемой задержкой, распознавание
+речи - заглушкой в пуле потоков Whisper.
+
+Режим --sweep повторяет замер при разных значениях одного параметра: опции bench.py
+(users=1,5,20) или настройки бота из окружения (WHISPER_WORKERS=1,2,4). Каждая точка -
+отдельный процесс, так как main.py читает настройки при импорте.
+
+Режим --workers прогоняет один поток через бота с разным числом процессов-обработчиков
+(каждый прогон - отдельный процесс, бот обращается к заглушкам по адресам из окружения).
+
+Режим --decode сравнивает декодирование голосового: прежний путь через временные
+файлы OGG и WAV и нынешний - в памяти.
+
+Режим --upload сравнивает подготовку картинки Stable Diffusion к отправке в Telegram:
+прежнее перекодирование в PNG через PIL, отправку как есть и перекодирование в JPEG.
+
+Режим --voice сравнивает на настоящем Whisper распознавание длинных голосовых
+целиком и по кускам: время от длины аудио и время до первого готового фрагмента.
+
+Примеры:
+    python bench.py --updates 500 --users 50
+    python bench.py --dump updates.jsonl --updates 1000
+    python bench.py --replay updates.jsonl --ollama-token-delay 0.02 --json result.json
+    python bench.py --voice long1.ogg long2.ogg
+    python bench.py --decode voice.ogg
+    python bench.py --upload
+    python bench.py --workers 1,2,4 --updates 1000 --users 200
+    LLM_CONCURRENCY=16 python bench.py --sweep users=1,4,16,64 --mix text=100 --updates 256
+    python bench.py --sweep known_users=0,10000,100000 --mix command=100 --telegram-latency 0
+    python bench.py --sweep WHISPER_WORKERS=1,2,4 --mix voice=100 --updates 120 --whisper-latency 1
+    ANSWER_CACHE_SIZE=0 LLM_CONCURRENCY=8 python bench.py --sweep photo_size=640x480,1280x960,2560x1920 \\
+        --mix photo=100 --updates 40 --users 40
+    python bench.py --sweep delivery=polling,webhook --mix command=100 --rate 200 --updates 1000
+    LLM_CONCURRENCY=1 python bench.py --sweep HISTORY_TRIM_TARGET=1,0.6 --mix text=100 --users 4 --updates 80 \\
+        --ollama-prompt-token-delay 0.002
+    WHISPER_WORKERS=1 python bench.py --sweep VOICE_BATCH_WINDOW=0,0.1,0.3,1 --mix voice=100 --rate 4 \\
+        --updates 160 --users 100 --whisper-batch-cost 0.3
+"""
+import argparse
+import asyncio
+import base64
+import functools
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import wave
+from collections import Counter, defaultdict, deque
+
+import aiohttp
+import av
+import numpy as np
+import ollama
+from aiohttp import web
+from PIL import Image, ImageFilter
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+TOKEN = "123456:BENCH"
+WEBHOOK_SECRET = "bench-secret"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Состав синтетического потока по умолчанию (вес каждого вида обновлений)
+DEFAULT_MIX = "text=50,voice=15,photo=15,draw=5,command=15"
+# Для прогонов с процессами-обработчиками: голосовые там распознаёт настоящий Whisper
+WORKERS_MIX = "text=60,photo=25,command=15"
+PROMPTS = [
+    "Привет! Как дела?",
+    "Объясни, как работает фотосинтез",
+    "Напиши короткое стихотворение про осень",
+    "Чем отличается список от кортежа в Python?",
+    "Придумай название для кофейни",
+]
+COMMANDS = ["/info", "/models", "/queue", "/think 1", "/think 0", "/temp 0.5", "/cs 10", "/help"]
+WORDS = "модель отвечает на вопрос пользователя подробно и по существу".split()
+
+def parse_mix(text):
+    """Разбор строки вида text=50,voice=15 в словарь весов"""
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+def parse_size(text):
+    """Разбор размера вида 1280x960"""
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def photo_sizes(width, height):
+    """Размеры, в которых Telegram хранит фото: по длинной стороне 90, 320, 800, 1280
+    и 2560 точек, но не больше оригинала. Последним идёт наибольший"""
+    longest = max(width, height)
+    largest = min(longest, 2560)
+    sides = [side for side in (90, 320, 800, 1280) if side < largest] + [largest]
+    return [
+        (side, round(width * side / longest), round(height * side / longest)) for side in sides
+    ]
+
+def synthetic_updates(count, users, mix, seed, photo_size=(1280, 960)):
+    """Синтетический поток обновлений в формате Telegram Bot API"""
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    now = int(time.time())
+    for update_id in range(1, count + 1):
+        user_id = 1000 + rng.randrange(users)
+        kind = rng.choices(kinds, weights)[0]
+        message = {
+            "message_id": update_id,
+            "date": now,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        if kind == "text":
+            message["text"] = rng.choice(PROMPTS)
+        elif kind in ("command", "draw"):
+            text = rng.choice(COMMANDS) if kind == "command" else f"/d {rng.choice(PROMPTS)}"
+            message["text"] = text
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ]
+        elif kind == "voice":
+            message["voice"] = {
+                "file_id": f"voice-{update_id}",
+                "file_unique_id": f"v{update_id}",
+                "duration": 5,
+                "mime_type": "audio/ogg",
+            }
+        elif kind == "photo":
+            # Часть картинок повторяется, как пересланные фото в реальных чатах
+            photo_id = rng.randrange(max(1, count // 10))
+            message["photo"] = [
+                {
+                    "file_id": f"photo-{photo_id}-{side}",
+                    "file_unique_id": f"p{photo_id}-{side}",
+                    "width": width,
+                    "height": height,
+                }
+                for side, width, height in photo_sizes(*photo_size)
+            ]
+            message["caption"] = "Что на картинке?"
+        else:
+            raise ValueError(f"Неизвестный вид обновления: {kind}")
+        yield {"update_id": update_id, "message": message}
+
+def load_updates(path):
+    """Обновления из JSONL-файла (по одному JSON обновления Telegram в строке)"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def noise_image(size, image_format):
+    """Картинка из шума: плохо сжимается, как настоящие фото"""
+    image = Image.effect_noise(size, 64).convert("RGB")
+    with io.BytesIO() as buffer:
+        image.save(buffer, format=image_format)
+        return buffer.getvalue()
+
+def embed_words(text, size=256):
+    """Эмбеддинг-заглушка: мешок слов, тексты из одних слов получают один вектор"""
+    vector = [0.0] * size
+    for word in text.lower().split():
+        vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % size] += 1.0
+    return vector
+
+def fake_transcribe(latency, batch_cost, voices):
+    """Заглушка распознавания речи: занимает поток пула на latency секунд за первое
+    сообщение пакета и на долю batch_cost от этого за каждое следующее"""
+    time.sleep(latency * (1 + batch_cost * (len(voices) - 1)))
+    return ["Расскажи что-нибудь интересное"] * len(voices)
+
+class Stubs:
+    """Локальные заглушки Telegram Bot API, Ollama и Stable Diffusion WebUI"""
+
+    def __init__(self, args):
+        self.args = args
+        self.calls = Counter()
+        self.message_ids = itertools.count(1_000_000)
+        self.photo_size = parse_size(args.photo_size)
+        self.photos = {}  # Длинная сторона -> JPEG этого размера
+        self.art = base64.b64encode(noise_image((1024, 1024), "PNG")).decode()
+        self.voice = b"OggS" + os.urandom(20_000)
+        # Кэш начала промта по моделям: последовательности (промт и ответ) в слотах Ollama
+        self.prompt_cache = defaultdict(lambda: deque(maxlen=args.ollama_cache_slots))
+        self.pending = []  # Обновления для getUpdates
+        self.published = asyncio.Event()
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.telegram_file)
+        app.router.add_post("/api/chat", self.ollama_chat)
+        app.router.add_post("/api/embed", self.ollama_embed)
+        app.router.add_get("/sdapi/v1/sd-models", self.sd_models)
+        app.router.add_get("/sdapi/v1/progress", self.sd_progress)
+        app.router.add_post("/sdapi/v1/txt2img", self.sd_txt2img)
+        app.router.add_get("/bench/calls", self.bench_calls)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def message(self, data):
+        chat_id = int(data.get("chat_id", 0))
+        return {
+            "message_id": int(data.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text", ""),
+        }
+
+    async def telegram(self, request):
+        method = request.match_info["method"].lower()
+        self.calls[f"telegram.{method}"] += 1
+        data = await request.post()
+        # Задержка сети поровну на запрос и ответ: ответ на длинный опрос
+        # идёт к боту уже после появления обновления
+        await asyncio.sleep(self.args.telegram_latency / 2)
+        if method == "getme":
+            result = BOT_USER
+        elif method == "getupdates":
+            result = await self.get_updates(data)
+        elif method in ("sendmessage", "editmessagetext", "sendphoto"):
+            result = self.message(data)
+        elif method == "getfile":
+            result = {
+                "file_id": data["file_id"],
+                "file_unique_id": data["file_id"],
+                "file_path": f"files/{data['file_id']}",
+            }
+        else:
+            result = True
+        await asyncio.sleep(self.args.telegram_latency / 2)
+        return web.json_response({"ok": True, "result": result})
+
+    def publish(self, update):
+        """Новое обновление для getUpdates"""
+        self.pending.append(update)
+        self.published.set()
+
+    async def get_updates(self, data):
+        """Длинный опрос: обновления начиная с offset или ожидание до timeout секунд"""
+        offset = int(data.get("offset") or 0)
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self.published.clear()
+            try:
+                async with asyncio.timeout(float(data.get("timeout") or 0)):
+                    await self.published.wait()
+            except TimeoutError:
+                pass
+        return self.pending[:int(data.get("limit") or 100)]
+
+    async def telegram_file(self, request):
+        await asyncio.sleep(self.args.telegram_latency)
+        path = request.match_info["path"]
+        if "voice" in path:
+            return web.Response(body=self.voice)
+        return web.Response(body=self.photo(path))
+
+    def photo(self, path):
+        """Фото размера из file_id (photo-N-сторона), без стороны - наибольший размер"""
+        sizes = {side: (width, height) for side, width, height in photo_sizes(*self.photo_size)}
+        side = path.rsplit("-", 1)[-1]
+        size = sizes.get(int(side) if side.isdigit() else 0, self.photo_size)
+        if size not in self.photos:
+            self.photos[size] = noise_image(size, "JPEG")
+        return self.photos[size]
+
+    def cached_prefix(self, model, prompt):
+        """Слот с самым длинным общим с промтом началом и длина этого начала (символов)"""
+        best, length = None, 0
+        for i, cached in enumerate(self.prompt_cache[model]):
+            common = len(os.path.commonprefix([prompt, cached]))
+            if common > length:
+                best, length = i, common
+        return best, length
+
+    def remember_prompt(self, model, slot, sequence):
+        """Обработанная последовательность остаётся в слоте, откуда взято начало"""
+        slots = self.prompt_cache[model]
+        if slot is None:
+            slots.append(sequence)
+        else:
+            slots[slot] = sequence
+
+    async def ollama_chat(self, request):
+        body = await request.json()
+        self.calls["ollama.chat"] += 1
+        tokens = self.args.ollama_tokens
+        delay = self.args.ollama_token_delay
+        # Ollama обрабатывает только токены промта после начала, уже лежащего в кэше
+        prompt = "".join(f"<{message['role']}>{message.get('content', '')}" for message in body["messages"])
+        slot, cached_chars = self.cached_prefix(body["model"], prompt)
+        prompt_tokens = len(prompt) // 3
+        evaluated = prompt_tokens - cached_chars // 3
+        self.calls["ollama.prompt_tokens"] += evaluated
+        self.calls["ollama.cached_prompt_tokens"] += prompt_tokens - evaluated
+        prompt_seconds = self.args.ollama_first_token + evaluated * self.args.ollama_prompt_token_delay
+        # Мультимодальная модель тратит время пропорционально числу точек картинки
+        megapixels = 0.0
+        for message in body["messages"]:
+            for image in message.get("images") or ():
+                self.calls["ollama.image_bytes"] += len(image)
+                width, height = Image.open(io.BytesIO(base64.b64decode(image))).size
+                megapixels += width * height / 1e6
+        await asyncio.sleep(megapixels * self.args.vision_latency)
+        final = {
+            "model": body["model"],
+            "created_at": "2025-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "eval_count": tokens,
+            "eval_duration": int(tokens * delay * 1e9) + 1,
+            "prompt_eval_count": evaluated,
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+        }
+        await asyncio.sleep(prompt_seconds)
+        words = [WORDS[i % len(WORDS)] + " " for i in range(tokens)]
+        self.remember_prompt(body["model"], slot, prompt + "<assistant>" + "".join(words))
+        if not body.get("stream", True):
+            await asyncio.sleep(tokens * delay)
+            final["message"]["content"] = "".join(words)
+            return web.json_response(final)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            for word in words:
+                chunk = {
+                    "model": body["model"],
+                    "created_at": final["created_at"],
+                    "message": {"role": "assistant", "content": word},
+                    "done": False,
+                }
+                await response.write((json.dumps(chunk) + "\n").encode())
+                await asyncio.sleep(delay)
+            await response.write((json.dumps(final) + "\n").encode())
+            await response.write_eof()
+        except ConnectionResetError:
+            # Бот остановил генерацию и закрыл соединение
+            self.calls["ollama.cancelled"] += 1
+        return response
+
+    async def ollama_embed(self, request):
+        body = await request.json()
+        self.calls["ollama.embed"] += 1
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response(
+            {"model": body["model"], "embeddings": [embed_words(text) for text in texts]}
+        )
+
+    async def sd_models(self, request):
+        return web.json_response([{"title": "sdXL_v10VAEFix.safetensors [e6bb9ea85b]"}])
+
+    async def sd_progress(self, request):
+        return web.json_response({"progress": 0.5, "eta_relative": self.args.sd_latency / 2})
+
+    async def sd_txt2img(self, request):
+        await request.json()
+        self.calls["sd.txt2img"] += 1
+        await asyncio.sleep(self.args.sd_latency)
+        return web.json_response({"images": [self.art]})
+
+    async def bench_calls(self, request):
+        """Счётчики запросов для прогонов в отдельных процессах"""
+        return web.json_response(self.calls)
+
+async def monitor_loop_lag(samples, interval=0.01):
+    """Замер задержки event loop: насколько позже срабатывает sleep(interval)"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def latency_stats(values):
+    """Число замеров и перцентили длительностей в миллисекундах"""
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values, default=0) * 1000,
+    }
+
+def known_users(bot, count):
+    """Зарегистрированные пользователи, которые в потоке не пишут"""
+    return {
+        str(10_000_000 + i): {**bot.DEFAULT_USER_DATA, "authenticated": True, "name": f"known{i}"}
+        for i in range(count)
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def post_webhook(session, url, data, latency):
+    """Доставка обновления, как её делает Telegram: запрос на адрес вебхука с секретом.
+    latency - задержка сети туда и обратно, как у запросов к Bot API"""
+    await asyncio.sleep(latency / 2)
+    async with session.post(
+        url, json=data, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    ) as response:
+        response.raise_for_status()
+
+def configure_environment(stubs, data_dir):
+    """Настройки main.py для теста. Заданные в окружении значения не перезаписываются,
+    кроме токена и адресов заглушек"""
+    os.environ["TOKEN"] = TOKEN
+    os.environ["SD_URL"] = stubs.url
+    os.environ["BOT_WORKERS"] = "1"
+    os.environ["METRICS_PORT"] = "0"
+    os.environ.setdefault("PASSWORD", "bench")
+    os.environ.setdefault("USER_DB_FILE", os.path.join(data_dir, "users.db"))
+    os.environ.setdefault("USER_DATA_FILE", os.path.join(data_dir, "users.json"))
+    os.environ.setdefault("CONTEXT_DB_FILE", os.path.join(data_dir, "context.db"))
+    os.environ.setdefault("RESPONSE_CACHE_DB", "")
+    # Синтетические пользователи не ждут ответа, поэтому лимиты и вытеснение
+    # генераций по умолчанию выключены
+    os.environ.setdefault("SUPERSEDE_PENDING", "0")
+    os.environ.setdefault("LLM_QUEUE_LIMIT", "0")
+    for capability in ("TEXT", "VOICE", "IMAGE", "DRAW"):
+        os.environ.setdefault(f"RATE_{capability}_PER_MIN", "0")
+
+async def run(args, updates):
+    stubs = Stubs(args)
+    await stubs.start()
+    configure_environment(stubs, tempfile.mkdtemp(prefix="bench-"))
+    bot = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Подмена внешних сервисов
+    bot.ollama_client = ollama.AsyncClient(host=stubs.url)
+    bot.voice_queue.batch_func = functools.partial(
+        fake_transcribe, args.whisper_latency, args.whisper_batch_cost
+    )
+
+    # Длительности обработчиков без округления до корзин гистограммы
+    durations = defaultdict(list)
+    voice_batches = []
+    prompt_evals = []
+    observe = bot.metrics.observe
+
+    def capture(name, value, **labels):
+        if name == "bot_handler_seconds":
+            durations[labels["handler"]].append(value)
+        elif name == "voice_batch_size":
+            voice_batches.append(value)
+        elif name == "llm_prompt_eval_seconds":
+            prompt_evals.append(value)
+        observe(name, value, **labels)
+
+    bot.metrics.observe = capture
+
+    if args.known_users:
+        # Хранилище с большим числом пользователей: запись изменений не должна от него зависеть
+        bot.user_store.write(known_users(bot, args.known_users), ())
+    started = time.perf_counter()
+    bot.user_data = bot.load_user_data()
+    user_store = {"users": len(bot.user_data), "load_seconds": time.perf_counter() - started}
+    bot.user_data.update(authorize_users(bot, updates))
+
+    # Длительность записей в хранилище настроек (идут в пуле потоков)
+    store_writes = []
+    store_write = bot.user_store.write
+
+    def timed_write(changed, deleted):
+        started = time.perf_counter()
+        store_write(changed, deleted)
+        store_writes.append(time.perf_counter() - started)
+
+    bot.user_store.write = timed_write
+
+    builder = ApplicationBuilder().base_url(f"{stubs.url}/bot").base_file_url(f"{stubs.url}/file/bot")
+    if args.delivery == "queue":
+        builder = builder.updater(None)
+    application = bot.build_application(builder)
+    await application.initialize()
+    await bot.on_startup(application)
+    await application.start()
+
+    # Задержка доставки: от появления обновления до его постановки в очередь приложения
+    published, received = {}, {}
+    queue_put = application.update_queue.put
+
+    async def put(update):
+        if isinstance(update, Update):
+            received[update.update_id] = time.perf_counter()
+        await queue_put(update)
+
+    application.update_queue.put = put
+    session = None
+    deliveries = set()
+    if args.delivery == "polling":
+        await application.updater.start_polling(timeout=10)
+    elif args.delivery == "webhook":
+        port = free_port()
+        webhook_url = f"http://127.0.0.1:{port}/telegram"
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=port, url_path="telegram",
+            webhook_url=webhook_url, secret_token=WEBHOOK_SECRET,
+        )
+        session = aiohttp.ClientSession()
+
+    lag = []
+    monitor = asyncio.ensure_future(monitor_loop_lag(lag))
+    started = time.perf_counter()
+    for data in updates:
+        published[data["update_id"]] = time.perf_counter()
+        if args.delivery == "polling":
+            stubs.publish(data)
+        elif args.delivery == "webhook":
+            deliveries.add(asyncio.ensure_future(
+                post_webhook(session, webhook_url, data, args.telegram_latency)
+            ))
+        else:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    if deliveries:
+        await asyncio.gather(*deliveries)
+    while len(received) < len(updates):
+        await asyncio.sleep(0.01)
+    await application.update_queue.join()
+    # Генерации картинок идут фоновыми задачами
+    while bot.sd_jobs:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+
+    if application.updater:
+        await application.updater.stop()
+    if session:
+        await session.close()
+    await application.stop()
+    await bot.on_shutdown(application)
+    await application.shutdown()
+    await stubs.stop()
+
+    return {
+        "updates": len(updates),
+        "seconds": elapsed,
+        "throughput": len(updates) / elapsed,
+        "handlers": {name: latency_stats(values) for name, values in sorted(durations.items())},
+        "prompt_eval": {
+            "seconds": sum(prompt_evals),
+            "tokens": stubs.calls["ollama.prompt_tokens"],
+            "cached_tokens": stubs.calls["ollama.cached_prompt_tokens"],
+            **latency_stats(prompt_evals),
+        },
+        "delivery": {
+            "mode": args.delivery,
+            **latency_stats([received[key] - published[key] for key in published]),
+        },
+        "voice_batches": {
+            "count": len(voice_batches),
+            "mean_size": sum(voice_batches) / len(voice_batches) if voice_batches else 0.0,
+        },
+        "loop_lag_ms": {
+            "p50": percentile(lag, 0.5) * 1000,
+            "p99": percentile(lag, 0.99) * 1000,
+            "max": max(lag, default=0) * 1000,
+        },
+        # ru_maxrss в Linux - в килобайтах
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stub_calls": dict(stubs.calls),
+        "user_store": {**user_store, "writes": latency_stats(store_writes)},
+    }
+
+def parse_sizes(text):
+    """Разбор списка вида 1,2,4"""
+    return [int(part) for part in text.split(",")]
+
+def authorize_users(bot, updates):
+    """Все пользователи потока уже авторизованы"""
+    users = {}
+    for data in updates:
+        user = data.get("message", {}).get("from")
+        if user:
+            users[str(user["id"])] = {
+                **bot.DEFAULT_USER_DATA,
+                "authenticated": True,
+                "name": user.get("first_name", "bench"),
+            }
+    return users
+
+async def run_workers(args, updates):
+    """Один и тот же поток через BOT_WORKERS=1, 2, 4...
+    Каждый прогон - отдельный процесс бота (основной процесс и обработчики),
+    заглушки работают в этом процессе"""
+    stubs = Stubs(args)
+    await stubs.start()
+    runs = []
+    for workers in parse_sizes(args.workers):
+        data_dir = tempfile.mkdtemp(prefix="bench-")
+        path = os.path.join(data_dir, "updates.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for data in updates:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        env = {
+            **os.environ,
+            "BENCH_STUBS_URL": stubs.url,
+            "TELEGRAM_API_URL": stubs.url,
+            "OLLAMA_HOST": stubs.url,
+            "BOT_WORKERS": str(workers),
+            "USER_DB_FILE": os.path.join(data_dir, "users.db"),
+            "USER_DATA_FILE": os.path.join(data_dir, "users.json"),
+            "CONTEXT_DB_FILE": os.path.join(data_dir, "context.db"),
+        }
+        # Заглушка Ollama отвечает параллельно, ограничение моделей не должно быть узким местом
+        env.setdefault("LLM_CONCURRENCY", "64")
+        env.setdefault("LLM_MAX_LOADED_MODELS", "3")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--worker-run", path,
+            env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        output, log = await process.communicate()
+        if process.returncode:
+            sys.stderr.write(log.decode(errors="replace")[-5000:])
+            raise RuntimeError(f"Прогон с BOT_WORKERS={workers} завершился с кодом {process.returncode}")
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    await stubs.stop()
+    return {"updates": len(updates), "cpus": os.cpu_count(), "runs": runs}
+
+async def stub_calls(url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}/bench/calls") as response:
+            return Counter(await response.json())
+
+async def worker_run(path):
+    """Один прогон run_workers: основной процесс бота в этом процессе, обработчики - дочерние"""
+    url = os.environ["BENCH_STUBS_URL"]
+    os.environ["TOKEN"] = TOKEN
+    os.environ["SD_URL"] = url
+    os.environ["METRICS_PORT"] = "0"
+    os.environ.setdefault("PASSWORD", "bench")
+    os.environ.setdefault("RESPONSE_CACHE_DB", "")
+    os.environ.setdefault("SUPERSEDE_PENDING", "0")
+    os.environ.setdefault("LLM_QUEUE_LIMIT", "0")
+    for capability in ("TEXT", "VOICE", "IMAGE", "DRAW"):
+        os.environ.setdefault(f"RATE_{capability}_PER_MIN", "0")
+    bot = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+    updates = load_updates(path)
+    bot.user_store.write(authorize_users(bot, updates), ())
+
+    application = bot.build_front_application()
+    await application.initialize()
+    ready = (await stub_calls(url))["telegram.getme"] + bot.BOT_WORKERS
+    await bot.start_workers(application)
+    # Обработчик готов, когда его приложение запросило getMe
+    while (await stub_calls(url))["telegram.getme"] < ready:
+        await asyncio.sleep(0.1)
+
+    cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    for data in updates:
+        await bot.forward_update(Update.de_json(data, application.bot), None)
+    # Обработчики завершаются, когда обработают всё, что успели получить
+    await bot.stop_workers(application)
+    elapsed = time.perf_counter() - started
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    await application.shutdown()
+    print(json.dumps({
+        "workers": bot.BOT_WORKERS,
+        "seconds": elapsed,
+        "throughput": len(updates) / elapsed,
+        # Время CPU обработчиков вместе с импортом и запуском
+        "worker_cpu_seconds": children.ru_utime + children.ru_stime - cpu.ru_utime - cpu.ru_stime,
+    }))
+
+def parse_sweep(text):
+    """Разбор --sweep вида users=1,5,20 в имя параметра и список значений"""
+    name, values = text.split("=", 1)
+    return name.strip(), values.split(",")
+
+def strip_options(argv, names):
+    """Аргументы командной строки без опций names и их значений"""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif arg.split("=", 1)[0] not in names:
+            result.append(arg)
+    return result
+
+async def run_sweep(args):
+    """Один и тот же замер при разных значениях параметра, каждая точка - отдельный процесс.
+    Параметр в верхнем регистре - переменная окружения бота, иначе опция bench.py"""
+    name, values = parse_sweep(args.sweep)
+    argv = strip_options(sys.argv[1:], ("--sweep", "--json"))
+    points = []
+    for value in values:
+        with tempfile.TemporaryDirectory(prefix="bench-") as data_dir:
+            path = os.path.join(data_dir, "result.json")
+            env = dict(os.environ)
+            point_argv = argv + ["--json", path]
+            if name.isupper():
+                env[name] = value
+            else:
+                point_argv += [f"--{name.replace('_', '-')}", value]
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), *point_argv,
+                env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            )
+            _, log = await process.communicate()
+            if process.returncode:
+                sys.stderr.write(log.decode(errors="replace")[-5000:])
+                raise RuntimeError(f"Прогон с {name}={value} завершился с кодом {process.returncode}")
+            with open(path, encoding="utf-8") as f:
+                points.append({"value": value, **json.load(f)})
+    return {"parameter": name, "points": points}
+
+def print_sweep_report(result, handler=None):
+    """Таблица по точкам: время, пропускная способность, вызовы в минуту и задержки
+    одного обработчика (по умолчанию самого частого)"""
+    if handler is None:
+        counts = Counter()
+        for point in result["points"]:
+            counts.update({name: stats["count"] for name, stats in point["handlers"].items()})
+        handler = counts.most_common(1)[0][0] if counts else ""
+    # При сравнении размеров хранилища - ещё его загрузка и запись,
+    # для голосовых - средний размер пакета распознавания
+    store = result["parameter"] in ("known_users", "USER_STORE")
+    voice = handler == "handle_voice"
+    images = handler in ("handle_image", "analyze_image")
+    delivery = result["parameter"] == "delivery"
+    prompt = handler == "handle_message"
+    print(f"Задержка обработчика {handler}")
+    header = (
+        f"{result['parameter']:>16}{'обн.':>7}{'время, с':>10}{'обн/с':>9}"
+        f"{'вызовов/мин':>13}{'p50, мс':>10}{'p95, мс':>10}"
+    )
+    if store:
+        header += f"{'загрузка, с':>13}{'запись p95, мс':>16}"
+    if voice:
+        header += f"{'пакет':>7}"
+    if images:
+        header += f"{'в Ollama, КБ':>14}"
+    if delivery:
+        header += f"{'доставка p50, мс':>18}{'p95, мс':>10}"
+    if prompt:
+        header += f"{'промты, с':>11}{'токенов':>9}{'из кэша':>9}"
+    print(header)
+    for point in result["points"]:
+        stats = point["handlers"].get(handler, latency_stats([]))
+        line = (
+            f"{point['value']:>16}{point['updates']:>7}{point['seconds']:>10.2f}{point['throughput']:>9.1f}"
+            f"{stats['count'] * 60 / point['seconds']:>13.0f}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+        )
+        if store:
+            line += f"{point['user_store']['load_seconds']:>13.2f}{point['user_store']['writes']['p95_ms']:>16.2f}"
+        if voice:
+            line += f"{point['voice_batches']['mean_size']:>7.1f}"
+        if images:
+            # Base64 картинок в запросах к модели на один вызов обработчика
+            image_bytes = point["stub_calls"].get("ollama.image_bytes", 0)
+            line += f"{image_bytes / max(1, stats['count']) / 1024:>14.0f}"
+        if delivery:
+            line += f"{point['delivery']['p50_ms']:>18.1f}{point['delivery']['p95_ms']:>10.1f}"
+        if prompt:
+            evals = point["prompt_eval"]
+            line += f"{evals['seconds']:>11.2f}{evals['tokens']:>9}{evals['cached_tokens']:>9}"
+        print(line)
+
+def print_workers_report(result):
+    print(f"Обновлений: {result['updates']}, ядер CPU: {result['cpus']}")
+    print(f"{'Процессов':>10}{'время, с':>10}{'обн/с':>9}{'ускорение':>11}{'CPU, с':>9}")
+    base = result["runs"][0]["throughput"]
+    for run in result["runs"]:
+        print(
+            f"{run['workers']:>10}{run['seconds']:>10.2f}{run['throughput']:>9.1f}"
+            f"{run['throughput'] / base:>10.2f}x{run['worker_cpu_seconds']:>9.1f}"
+        )
+
+class VoiceStatus:
+    """Сообщение статуса: запоминает, когда пришёл первый частичный транскрипт"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_partial = None
+
+    async def edit_text(self, text):
+        if self.first_partial is None:
+            self.first_partial = time.monotonic() - self.started
+
+def import_bot():
+    """main.py для замеров отдельных функций, без заглушек сервисов"""
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ.setdefault("PASSWORD", "bench")
+    os.environ["BOT_WORKERS"] = "1"
+    os.environ["METRICS_PORT"] = "0"
+    data_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("USER_DB_FILE", os.path.join(data_dir, "users.db"))
+    os.environ.setdefault("USER_DATA_FILE", os.path.join(data_dir, "users.json"))
+    os.environ.setdefault("CONTEXT_DB_FILE", os.path.join(data_dir, "context.db"))
+    bot = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+def synthetic_voice(seconds=30, sampling_rate=48000):
+    """Голосовое как от Telegram (Opus в OGG): тон с паузами раз в секунду"""
+    t = np.arange(int(seconds * sampling_rate)) / sampling_rate
+    audio = (0.3 * np.sin(2 * np.pi * 220 * t) * (np.sin(np.pi * t) > 0)).astype(np.float32)
+    with io.BytesIO() as buffer:
+        with av.open(buffer, "w", format="ogg") as container:
+            stream = container.add_stream("libopus", rate=sampling_rate)
+            stream.layout = "mono"
+            for start in range(0, len(audio), 960):
+                frame = av.AudioFrame.from_ndarray(audio[None, start:start + 960], format="flt", layout="mono")
+                frame.sample_rate = sampling_rate
+                frame.pts = start
+                for packet in stream.encode(frame):
+                    container.mux(packet)
+            for packet in stream.encode(None):
+                container.mux(packet)
+        return buffer.getvalue()
+
+def decode_with_temp_files(bot, voice_bytes):
+    """Прежний путь: OGG во временный файл, перекодирование в WAV 16 кГц моно во второй
+    временный файл и чтение его при распознавании. Процесс ffmpeg, который запускал
+    pydub, не учитывается, так что прежний путь на деле ещё медленнее"""
+    with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as ogg:
+        ogg.write(voice_bytes)
+    wav_path = ogg.name[:-4] + ".wav"
+    try:
+        audio = bot.decode_audio(ogg.name, sampling_rate=16000)
+        with wave.open(wav_path, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+            wav.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+        disk_bytes = len(voice_bytes) + os.path.getsize(wav_path)
+        return bot.decode_audio(wav_path, sampling_rate=16000), disk_bytes
+    finally:
+        os.unlink(ogg.name)
+        if os.path.exists(wav_path):
+            os.unlink(wav_path)
+
+def time_call(func, repeat):
+    """Медиана времени и процессорного времени вызова, в миллисекундах"""
+    wall, cpu = [], []
+    for _ in range(repeat):
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+        func()
+        wall.append(time.perf_counter() - wall_started)
+        cpu.append(time.process_time() - cpu_started)
+    return percentile(wall, 0.5) * 1000, percentile(cpu, 0.5) * 1000
+
+def run_decode(paths, repeat):
+    """Декодирование голосовых прежним путём и в памяти"""
+    bot = import_bot()
+    voices = [(path, open(path, "rb").read()) for path in paths]
+    if not voices:
+        voices = [(f"синтетическое {seconds} с", synthetic_voice(seconds)) for seconds in (5, 30, 120)]
+    results = []
+    for name, voice_bytes in voices:
+        _, disk_bytes = decode_with_temp_files(bot, voice_bytes)
+        old_wall, old_cpu = time_call(lambda: decode_with_temp_files(bot, voice_bytes), repeat)
+        new_wall, new_cpu = time_call(lambda: bot.load_audio(voice_bytes), repeat)
+        results.append({
+            "file": name,
+            "audio_seconds": len(bot.load_audio(voice_bytes)) / 16000,
+            "old_ms": old_wall,
+            "old_cpu_ms": old_cpu,
+            "old_disk_bytes": disk_bytes,
+            "new_ms": new_wall,
+            "new_cpu_ms": new_cpu,
+        })
+    return {"repeat": repeat, "voices": results}
+
+def print_decode_report(result):
+    print(f"Медиана из {result['repeat']} повторов")
+    print(
+        f"{'Аудио, с':>9}{'файлы, мс':>11}{'CPU, мс':>9}{'на диск, КБ':>13}"
+        f"{'память, мс':>12}{'CPU, мс':>9}{'ускорение':>11}  Файл"
+    )
+    for voice in result["voices"]:
+        print(
+            f"{voice['audio_seconds']:>9.1f}{voice['old_ms']:>11.1f}{voice['old_cpu_ms']:>9.1f}"
+            f"{voice['old_disk_bytes'] / 1024:>13.0f}{voice['new_ms']:>12.1f}{voice['new_cpu_ms']:>9.1f}"
+            f"{voice['old_ms'] / voice['new_ms']:>10.2f}x  {voice['file']}"
+        )
+
+def smooth_image(size):
+    """Картинка, похожая на результат генерации: плавные переходы и мелкие детали"""
+    gradient = Image.linear_gradient("L").resize(size)
+    details = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(2))
+    return Image.merge("RGB", (gradient, details, gradient.rotate(90).resize(size)))
+
+def sd_images():
+    """PNG 1024x1024 в base64, как их возвращает txt2img"""
+    with io.BytesIO() as buffer:
+        smooth_image((1024, 1024)).save(buffer, format="PNG")
+        smooth = buffer.getvalue()
+    return {
+        "плавная": base64.b64encode(smooth).decode(),
+        "шум": base64.b64encode(noise_image((1024, 1024), "PNG")).decode(),
+    }
+
+def reencode_png(image_base64):
+    """Прежний путь: декодирование и сохранение в PNG через PIL"""
+    with io.BytesIO() as img_buffer:
+        Image.open(io.BytesIO(base64.b64decode(image_base64))).save(img_buffer, format="PNG")
+        return img_buffer.getvalue()
+
+def run_upload(repeat):
+    """Время, процессорное время и размер отправки сгенерированной картинки"""
+    bot = import_bot()
+    loop = asyncio.new_event_loop()
+
+    def prepare(image_base64, upload_format):
+        bot.SD_UPLOAD_FORMAT = upload_format
+        data, _ = loop.run_until_complete(bot.prepare_image_upload(base64.b64decode(image_base64)))
+        return data
+
+    results = []
+    for name, image_base64 in sd_images().items():
+        paths = {
+            "PNG через PIL (прежний)": functools.partial(reencode_png, image_base64),
+            "как есть (original)": functools.partial(prepare, image_base64, "original"),
+            f"JPEG q{bot.SD_JPEG_QUALITY} (jpeg)": functools.partial(prepare, image_base64, "jpeg"),
+        }
+        for path, func in paths.items():
+            wall, cpu = time_call(func, repeat)
+            results.append({"image": name, "path": path, "ms": wall, "cpu_ms": cpu, "bytes": len(func())})
+    loop.close()
+    return {"repeat": repeat, "images": results}
+
+def print_upload_report(result):
+    print(f"Картинка 1024x1024, медиана из {result['repeat']} повторов")
+    print(f"{'Картинка':<10}{'Путь':<26}{'время, мс':>11}{'CPU, мс':>9}{'отправка, КБ':>14}")
+    for item in result["images"]:
+        print(
+            f"{item['image']:<10}{item['path']:<26}{item['ms']:>11.1f}"
+            f"{item['cpu_ms']:>9.1f}{item['bytes'] / 1024:>14.0f}"
+        )
+
+async def run_voice(paths):
+    """Распознавание файлов настоящим Whisper: целиком и по кускам"""
+    bot = import_bot()
+    loop = asyncio.get_running_loop()
+    # Загрузка модели не входит в замер
+    await loop.run_in_executor(bot.voice_queue.executor, bot.get_whisper_model)
+
+    results = []
+    for path in paths:
+        with open(path, "rb") as f:
+            voice_bytes = f.read()
+        audio = bot.decode_audio(io.BytesIO(voice_bytes), sampling_rate=16000)
+        start = time.monotonic()
+        await loop.run_in_executor(bot.voice_queue.executor, bot.transcribe_voice, voice_bytes)
+        whole = time.monotonic() - start
+        status = VoiceStatus()
+        await bot.transcribe_long_voice(0, voice_bytes, status)
+        chunked = time.monotonic() - status.started
+        results.append({
+            "file": path,
+            "audio_seconds": len(audio) / 16000,
+            "whole_seconds": whole,
+            "chunked_seconds": chunked,
+            "first_partial_seconds": status.first_partial,
+        })
+    return {"workers": bot.WHISPER_WORKERS, "threads": bot.WHISPER_THREADS, "voices": results}
+
+def print_voice_report(result):
+    print(f"Воркеров Whisper: {result['workers']}, потоков на воркер: {result['threads']}")
+    print(f"{'Аудио, с':>9}{'целиком, с':>12}{'куски, с':>10}{'ускорение':>11}{'первый фрагмент, с':>20}  Файл")
+    for voice in result["voices"]:
+        first = voice["first_partial_seconds"]
+        print(
+            f"{voice['audio_seconds']:>9.1f}{voice['whole_seconds']:>12.1f}{voice['chunked_seconds']:>10.1f}"
+            f"{voice['whole_seconds'] / voice['chunked_seconds']:>10.1f}x"
+            f"{'-' if first is None else f'{first:.1f}':>20}  {voice['file']}"
+        )
+
+def print_report(result):
+    print(
+        f"Обновлений: {result['updates']} за {result['seconds']:.2f} с "
+        f"({result['throughput']:.1f} обн/с)"
+    )
+    print(f"{'Обработчик':<20}{'вызовов':>9}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}{'макс, мс':>11}")
+    for name, stats in result["handlers"].items():
+        print(
+            f"{name:<20}{stats['count']:>9}{stats['p50_ms']:>11.1f}{stats['p95_ms']:>11.1f}"
+            f"{stats['p99_ms']:>11.1f}{stats['max_ms']:>11.1f}"
+        )
+    delivery = result["delivery"]
+    print(
+        f"Доставка обновлений ({delivery['mode']}): p50 {delivery['p50_ms']:.1f} мс, "
+        f"p95 {delivery['p95_ms']:.1f} мс, макс {delivery['max_ms']:.1f} мс"
+    )
+    prompt = result["prompt_eval"]
+    if prompt["count"]:
+        print(
+            f"Обработка промтов Ollama: {prompt['seconds']:.2f} с за {prompt['count']} запросов "
+            f"(p50 {prompt['p50_ms']:.0f} мс, p95 {prompt['p95_ms']:.0f} мс), "
+            f"токенов {prompt['tokens']}, из кэша {prompt['cached_tokens']}"
+        )
+    lag = result["loop_lag_ms"]
+    print(f"Задержка event loop: p50 {lag['p50']:.1f} мс, p99 {lag['p99']:.1f} мс, макс {lag['max']:.1f} мс")
+    print(f"Пиковая RSS: {result['peak_rss_mb']:.0f} МБ")
+    if result["voice_batches"]["count"]:
+        batches = result["voice_batches"]
+        print(f"Пакетов распознавания: {batches['count']}, в среднем {batches['mean_size']:.1f} голосовых")
+    store = result["user_store"]
+    print(
+        f"Хранилище настроек: {store['users']} пользователей, загрузка {store['load_seconds']:.2f} с, "
+        f"записей {store['writes']['count']}, p50 {store['writes']['p50_ms']:.2f} мс, "
+        f"p95 {store['writes']['p95_ms']:.2f} мс"
+    )
+    print("Запросов к заглушкам: " + ", ".join(f"{k} {v}" for k, v in sorted(result["stub_calls"].items())))
+
+def save_json(path, result):
+    """Сохранение результатов, если задан --json"""
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками внешних сервисов")
+    parser.add_argument("--replay", help="JSONL-файл с обновлениями Telegram")
+    parser.add_argument("--dump", help="Записать синтетический поток в JSONL-файл и выйти")
+    parser.add_argument("--updates", type=int, default=200, help="Число синтетических обновлений")
+    parser.add_argument("--users", type=int, default=30, help="Число синтетических пользователей")
+    parser.add_argument("--mix", help=f"Состав потока (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--known-users", type=int, default=0, help="Зарегистрировать заранее столько пользователей")
+    parser.add_argument("--rate", type=float, default=0, help="Обновлений в секунду (0 - все сразу)")
+    parser.add_argument(
+        "--delivery", choices=("queue", "polling", "webhook"), default="queue",
+        help="Получение обновлений: прямо в очередь, getUpdates или вебхук",
+    )
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка Bot API (с)")
+    parser.add_argument("--ollama-first-token", type=float, default=0.05, help="Время до первого токена (с)")
+    parser.add_argument("--ollama-token-delay", type=float, default=0.002, help="Задержка на токен (с)")
+    parser.add_argument("--ollama-tokens", type=int, default=50, help="Токенов в ответе")
+    parser.add_argument(
+        "--ollama-prompt-token-delay", type=float, default=0.0,
+        help="Обработка токена промта, не найденного в кэше (с)",
+    )
+    parser.add_argument("--ollama-cache-slots", type=int, default=4, help="Последовательностей в кэше модели")
+    parser.add_argument("--photo-size", default="1280x960", help="Размер оригиналов фото")
+    parser.add_argument(
+        "--vision-latency", type=float, default=0.5, help="Время обработки картинки моделью на мегапиксель (с)"
+    )
+    parser.add_argument("--sd-latency", type=float, default=2.0, help="Время генерации картинки (с)")
+    parser.add_argument("--whisper-latency", type=float, default=0.3, help="Распознавание одного голосового (с)")
+    parser.add_argument(
+        "--whisper-batch-cost", type=float, default=1.0,
+        help="Доля времени распознавания за каждое следующее голосовое в пакете (1 - пакеты не быстрее)",
+    )
+    parser.add_argument("--decode", nargs="*", help="Сравнить декодирование голосовых (без файлов - синтетические)")
+    parser.add_argument("--upload", action="store_true", help="Сравнить подготовку картинок SD к отправке")
+    parser.add_argument("--repeat", type=int, default=20, help="Повторов каждого замера --decode и --upload")
+    parser.add_argument("--voice", nargs="+", help="Замерить распознавание аудиофайлов настоящим Whisper")
+    parser.add_argument("--sweep", help="Повторить замер для значений параметра, например users=1,5,20")
+    parser.add_argument("--handler", help="Обработчик для таблицы --sweep (по умолчанию самый частый)")
+    parser.add_argument("--workers", help="Сравнить BOT_WORKERS из списка, например 1,2,4")
+    parser.add_argument("--worker-run", help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    if args.worker_run:
+        asyncio.run(worker_run(args.worker_run))
+        return
+
+    if args.sweep:
+        result = asyncio.run(run_sweep(args))
+        print_sweep_report(result, args.handler)
+        save_json(args.json, result)
+        return
+
+    if args.decode is not None:
+        result = run_decode(args.decode, args.repeat)
+        print_decode_report(result)
+        save_json(args.json, result)
+        return
+
+    if args.upload:
+        result = run_upload(args.repeat)
+        print_upload_report(result)
+        save_json(args.json, result)
+        return
+
+    if args.voice:
+        result = asyncio.run(run_voice(args.voice))
+        print_voice_report(result)
+        save_json(args.json, result)
+        return
+
+    if args.replay:
+        updates = load_updates(args.replay)
+    else:
+        mix = args.mix or (WORKERS_MIX if args.workers else DEFAULT_MIX)
+        updates = list(synthetic_updates(
+            args.updates, args.users, parse_mix(mix), args.seed, parse_size(args.photo_size)
+        ))
+    if args.dump:
+        with open(args.dump, "w", encoding="utf-8") as f:
+            for data in updates:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        return
+
+    if args.workers:
+        result = asyncio.run(run_workers(args, updates))
+        print_workers_report(result)
+    else:
+        result = asyncio.run(run(args, updates))
+        print_report(result)
+    save_json(args.json, result)
+
+if __name__ == "__main__":
+    sys.exit(main())
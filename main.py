@@ -1,27 +1,49 @@
+import time
+
+# Время запуска процесса (для замера времени старта), до импорта тяжёлых библиотек
+STARTED_AT = time.monotonic()
+
 import logging
 import json
 import os
 from telegram import Update, InputFile
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
 import ollama
-import nest_asyncio
-from faster_whisper import WhisperModel
-from pydub import AudioSegment
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+import numpy as np
 from PIL import Image
 import io
 import base64
-import tempfile
+import hashlib
 import aiohttp
+from aiohttp import web
 import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import math
+import multiprocessing
+import signal
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from dotenv import load_dotenv
 
-nest_asyncio.apply()
 # Загрузка переменных окружения
 load_dotenv()
 # Настройка логирования
@@ -29,14 +51,54 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 
-# Инициализация модели распознавания речи
-whisper_model = WhisperModel("base", device="cpu", compute_type="int8")
+# Число процессов-обработчиков (1 - всё в одном процессе). Основной процесс
+# принимает обновления и распределяет их между обработчиками по user_id, а также
+# выдаёт им места в общих очередях Ollama и Stable Diffusion, поэтому
+# LLM_CONCURRENCY и SD_CONCURRENCY действуют на все процессы вместе.
+# Пул Whisper и очередь голосовых у каждого процесса свои (ядра делятся поровну)
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "1")))
+# Длина очереди обновлений каждого процесса-обработчика
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+# Ядра CPU, доступные одному процессу
+WORKER_CPUS = max(1, (os.cpu_count() or 1) // BOT_WORKERS)
+
+# Число параллельных распознаваний и длина очереди голосовых сообщений
+WHISPER_WORKERS = int(os.getenv("WHISPER_WORKERS", max(1, WORKER_CPUS // 4)))
+VOICE_QUEUE_SIZE = int(os.getenv("VOICE_QUEUE_SIZE", "20"))
+# Пакетное распознавание: сколько сообщений объединять и сколько ждать попутчиков (сек)
+VOICE_BATCH_SIZE = int(os.getenv("VOICE_BATCH_SIZE", "4"))
+VOICE_BATCH_WINDOW = float(os.getenv("VOICE_BATCH_WINDOW", "0.1"))
+# Голосовые длиннее LONG_VOICE_SECONDS режутся по паузам на куски до LONG_VOICE_CHUNK сек,
+# куски распознаются параллельно, а готовый текст показывается по мере распознавания
+LONG_VOICE_SECONDS = float(os.getenv("LONG_VOICE_SECONDS", "60"))
+LONG_VOICE_CHUNK = float(os.getenv("LONG_VOICE_CHUNK", "30"))
+
+# Настройки модели распознавания речи (загружается при первом голосовом сообщении)
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+# Потоки CPU по умолчанию делятся между воркерами
+WHISPER_THREADS = int(os.getenv("WHISPER_THREADS", max(1, WORKER_CPUS // WHISPER_WORKERS)))
+# Выгрузка модели после простоя (сек), 0 - не выгружать
+WHISPER_IDLE_UNLOAD = float(os.getenv("WHISPER_IDLE_UNLOAD", "0"))
+# Фоновая загрузка модели сразу после старта
+WHISPER_WARMUP = os.getenv("WHISPER_WARMUP", "0") == "1"
 
 # Токен бота
 TOKEN = os.getenv("TOKEN")
+# Свой сервер Bot API вместо api.telegram.org (например, telegram-bot-api или заглушка бенчмарка)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
-# Файл для сохранения данных пользователей
-USER_DATA_FILE = ".user_data.json"
+# Файл для сохранения данных пользователей (формат json)
+USER_DATA_FILE = os.getenv("USER_DATA_FILE", ".user_data.json")
+# Хранилище настроек пользователей: sqlite (по умолчанию) или json
+USER_STORE = os.getenv("USER_STORE", "sqlite")
+USER_DB_FILE = os.getenv("USER_DB_FILE", ".user_data.db")
+# Задержка перед записью изменённых настроек и истории на диск (сек)
+USER_DATA_FLUSH_DELAY = float(os.getenv("USER_DATA_FLUSH_DELAY", "1.0"))
+# База истории диалогов и лимиты горячих диалогов в памяти
+CONTEXT_DB_FILE = os.getenv("CONTEXT_DB_FILE", ".context.db")
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "1000"))
+CONTEXT_TTL = float(os.getenv("CONTEXT_TTL", "3600"))
 
 # Системные настройки по умолчанию
 DEFAULT_SYSTEM_PROMPT = "You're a friendly helpful assistant answering in Russian"
@@ -46,6 +108,105 @@ PASSWORD = os.getenv("PASSWORD")  # Пароль для доступа
 # Проверка наличия токена и пароля
 if not TOKEN or not PASSWORD:
     raise ValueError("❌ Не заданы TOKEN или PASSWORD в .env")
+# Процессы-обработчики делят настройки через SQLite, JSON-файл перезаписывался бы целиком
+if BOT_WORKERS > 1 and USER_STORE == "json":
+    raise ValueError("❌ Для BOT_WORKERS > 1 нужно USER_STORE=sqlite")
+
+# Общий асинхронный клиент Ollama: переиспользует HTTP-соединения и не блокирует event loop
+ollama_client = ollama.AsyncClient()
+
+# Потоковая выдача ответов: сообщение-заглушка обновляется по мере генерации
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# Минимальный интервал между редактированиями сообщения (сек)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Планировщик запросов к Ollama: параллельных запросов на модель (как
+# OLLAMA_NUM_PARALLEL сервера), одновременно загруженных моделей, через сколько
+# секунд ожидания переключаться на другую модель, и keep_alive по умолчанию
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_MAX_LOADED_MODELS = int(os.getenv("LLM_MAX_LOADED_MODELS", "1"))
+LLM_SWITCH_AFTER = float(os.getenv("LLM_SWITCH_AFTER", "30"))
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "5m")
+# Приоритеты запросов (меньше - важнее)
+PRIORITY_TEXT = 0
+PRIORITY_IMAGE = 1
+
+# Ограничение частоты запросов пользователя по видам (text, voice, image, draw):
+# запросов в минуту и сколько можно отправить подряд (0 - без ограничения)
+RATE_LIMITS = {
+    "text": (float(os.getenv("RATE_TEXT_PER_MIN", "20")), int(os.getenv("RATE_TEXT_BURST", "5"))),
+    "voice": (float(os.getenv("RATE_VOICE_PER_MIN", "10")), int(os.getenv("RATE_VOICE_BURST", "3"))),
+    "image": (float(os.getenv("RATE_IMAGE_PER_MIN", "6")), int(os.getenv("RATE_IMAGE_BURST", "2"))),
+    "draw": (float(os.getenv("RATE_DRAW_PER_MIN", "3")), int(os.getenv("RATE_DRAW_BURST", "2"))),
+}
+# Сброс нагрузки: при скольких ожидающих запросах к Ollama отвечать "занят"
+# (0 - без ограничения) и через сколько секунд предлагать повторить
+LLM_QUEUE_LIMIT = int(os.getenv("LLM_QUEUE_LIMIT", "20"))
+BUSY_RETRY_AFTER = float(os.getenv("BUSY_RETRY_AFTER", "30"))
+
+# Stable Diffusion WebUI: адрес, одновременных генераций, длина очереди,
+# время жизни проверки моделей и период опроса прогресса (сек)
+SD_URL = os.getenv("SD_URL", "http://localhost:7860")
+SD_CONCURRENCY = int(os.getenv("SD_CONCURRENCY", "1"))
+SD_QUEUE_SIZE = int(os.getenv("SD_QUEUE_SIZE", "10"))
+SD_MODEL_CHECK_TTL = float(os.getenv("SD_MODEL_CHECK_TTL", "300"))
+SD_PROGRESS_INTERVAL = float(os.getenv("SD_PROGRESS_INTERVAL", "3"))
+# Формат отправки сгенерированных картинок: original (как есть) или jpeg
+SD_UPLOAD_FORMAT = os.getenv("SD_UPLOAD_FORMAT", "original")
+SD_JPEG_QUALITY = int(os.getenv("SD_JPEG_QUALITY", "90"))
+
+# Предобработка фото для мультимодальной модели: целевой размер по длинной
+# стороне (0 - брать оригинал) и уменьшение через Pillow до этого размера
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))
+VISION_RESIZE = os.getenv("VISION_RESIZE", "1") == "1"
+
+# Кэш ответов по картинкам и сгенерированных изображений: записей в памяти
+# и файл SQLite для второго уровня (пусто - только память), записей в нём
+# и время жизни записи на диске (сек)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "20"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")
+ANSWER_CACHE_DB_SIZE = int(os.getenv("ANSWER_CACHE_DB_SIZE", "10000"))
+IMAGE_CACHE_DB_SIZE = int(os.getenv("IMAGE_CACHE_DB_SIZE", "200"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(30 * 24 * 3600)))
+# Кэш ответов по смыслу для первых вопросов диалога (по умолчанию выключен):
+# модель эмбеддингов Ollama, порог косинусной близости, записей, время жизни (сек),
+# наибольшая температура, при которой ответ можно повторить, и файл SQLite
+# для сохранения между перезапусками (пусто - только память)
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "nomic-embed-text")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "5000"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_MAX_TEMPERATURE = float(os.getenv("SEMANTIC_CACHE_MAX_TEMPERATURE", "0.3"))
+SEMANTIC_CACHE_DB = os.getenv("SEMANTIC_CACHE_DB", "")
+# Фиксированный seed для SD (-1 - случайный, такие генерации не кэшируются)
+SD_SEED = int(os.getenv("SD_SEED", "-1"))
+
+# Метрики в формате Prometheus: адрес и порт HTTP (0 - выключено),
+# запись длительности этапов в лог
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_TRACE = os.getenv("METRICS_TRACE", "0") == "1"
+
+# Режим webhook вместо polling: публичный адрес бота (пусто - polling),
+# локальный адрес и порт, путь, секретный токен (обязателен) и число соединений от Telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # Без секрета обновления может прислать кто угодно
+    raise ValueError("❌ Для WEBHOOK_URL нужно задать WEBHOOK_SECRET в .env")
+# Сколько обновлений обрабатывать одновременно (сообщения одного пользователя
+# всё равно идут по порядку; обработчики, ждущие модель или распознавание,
+# слот не занимают) и сколько обновлений может ждать своей очереди
+UPDATE_CONCURRENCY = max(1, int(os.getenv("UPDATE_CONCURRENCY", "8")))
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", "1000"))
 
 # Доступные модели Ollama
 MODELS = {
@@ -54,6 +215,38 @@ MODELS = {
     "3": "qwen3-vl:8b",  # Мультимодальная модель для работы с изображениями
 }
 
+# Размер окна контекста каждой модели (передаётся в Ollama как num_ctx).
+# Значение для модели не должно меняться между запросами, иначе Ollama перезагружает её
+MODEL_NUM_CTX = {
+    "1": int(os.getenv("MODEL_NUM_CTX_1", "8192")),
+    "2": int(os.getenv("MODEL_NUM_CTX_2", "8192")),
+    "3": int(os.getenv("MODEL_NUM_CTX_3", "8192")),
+}
+# Сколько держать каждую модель в памяти после запроса (по умолчанию LLM_KEEP_ALIVE)
+MODEL_KEEP_ALIVE = {
+    "1": os.getenv("MODEL_KEEP_ALIVE_1", LLM_KEEP_ALIVE),
+    "2": os.getenv("MODEL_KEEP_ALIVE_2", LLM_KEEP_ALIVE),
+    "3": os.getenv("MODEL_KEEP_ALIVE_3", LLM_KEEP_ALIVE),
+}
+# До какой доли лимитов сокращается переполненная история. Старые сообщения
+# удаляются пачкой, и начало промта (кэш Ollama) не меняется несколько ходов подряд
+HISTORY_TRIM_TARGET = float(os.getenv("HISTORY_TRIM_TARGET", "0.6"))
+# Предельное время генерации ответа каждой моделью после начала запроса
+# (сек, 0 - без ограничения)
+MODEL_TIMEOUT = {
+    "1": float(os.getenv("MODEL_TIMEOUT_1", "600")),  # Размышления qwen3 бывают долгими
+    "2": float(os.getenv("MODEL_TIMEOUT_2", "300")),
+    "3": float(os.getenv("MODEL_TIMEOUT_3", "300")),
+}
+# Новое сообщение пользователя останавливает его незавершённую генерацию
+SUPERSEDE_PENDING = os.getenv("SUPERSEDE_PENDING", "1") == "1"
+# Запас токенов под ответ модели
+ANSWER_TOKEN_RESERVE = 2048
+# Грубая оценка длины токена в символах (с запасом для кириллицы)
+CHARS_PER_TOKEN = 3
+# Вставка на месте вырезанной середины слишком длинного сообщения
+TRUNCATION_MARK = "\n[…]\n"
+
 # Базовая структура данных пользователя
 DEFAULT_USER_DATA = {
     "authenticated": False,
@@ -65,52 +258,1570 @@ DEFAULT_USER_DATA = {
     "name": None,
 }
 
-# Загрузка данных пользователей из файла
-def load_user_data():
-    if os.path.exists(USER_DATA_FILE):
+class Metrics:
+    """Счётчики, гистограммы и датчики в текстовом формате Prometheus"""
+
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики корзин, сумма, количество]
+        self.gauges = []  # Функции, возвращающие [(имя, метки, значение)]
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def gauge(self, func):
+        """Регистрация датчика, значения которого вычисляются при выдаче"""
+        self.gauges.append(func)
+        return func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Замер длительности блока в гистограмму name"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.observe(name, elapsed, **labels)
+            if METRICS_TRACE:
+                logging.info(f"trace {name} {dict(labels)} {elapsed * 1000:.1f} мс")
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            return f"{name}{{{label_text}}} {value}"
+        return f"{name} {value}"
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(self._format(name, labels, value))
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                lines.append(self._format(f"{name}_bucket", labels + (("le", bound),), bucket))
+            lines.append(self._format(f"{name}_bucket", labels + (("le", "+Inf"),), count))
+            lines.append(self._format(f"{name}_sum", labels, total))
+            lines.append(self._format(f"{name}_count", labels, count))
+        for func in self.gauges:
+            for name, labels, value in func():
+                lines.append(self._format(name, self._labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def track_handler(handler=None, *, auth=None):
+    """Общая обёртка обработчиков Telegram.
+    Данные пользователя находятся один раз за обновление и кладутся в context.user_id
+    и context.user (обработчик, вызванный из другого, получает их готовыми).
+    Если задан auth, неавторизованному пользователю отправляется этот ответ,
+    а обработчик не вызывается. Время и ошибки обработчика пишутся в метрики"""
+    if handler is None:
+        return functools.partial(track_handler, auth=auth)
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
         try:
-            with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # Обновляем старые данные, добавляя недостающие поля
-                for user_id, user_info in data.items():
-                    data[user_id] = {**DEFAULT_USER_DATA, **user_info}
-                return data
-        except (json.JSONDecodeError, IOError) as e:
-            logging.warning(f"Ошибка загрузки данных: {e}")
-            return {}
-    return {}
-
-# Сохранение данных пользователей в файл
-def save_user_data(data):
+            with metrics.timer("bot_handler_seconds", handler=handler.__name__):
+                if getattr(context, "user", None) is None and update.effective_user:
+                    context.user_id = str(update.effective_user.id)
+                    context.user = ensure_user_data(context.user_id)
+                if auth and not context.user["authenticated"]:
+                    await update.message.reply_text(auth)
+                    return
+                return await handler(update, context)
+        except Exception:
+            metrics.inc("bot_errors_total", stage=handler.__name__)
+            raise
+    return wrapper
+
+async def serve_metrics(request):
+    """HTTP-обработчик /metrics"""
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+class JsonUserStore:
+    """Хранение настроек в JSON-файле, файл заменяется атомарно"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        return dict(self.data)
+
+    def write(self, changed, deleted):
+        with self.lock:
+            self.data.update(changed)
+            for user_id in deleted:
+                self.data.pop(user_id, None)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+class SqliteUserStore:
+    """Хранение настроек в SQLite (WAL): записываются только изменённые пользователи"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, data FROM users").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def write(self, changed, deleted):
+        # Одна транзакция на пакет изменений
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                [
+                    (user_id, json.dumps(info, ensure_ascii=False))
+                    for user_id, info in changed.items()
+                ],
+            )
+            self.conn.executemany(
+                "DELETE FROM users WHERE user_id = ?", [(user_id,) for user_id in deleted]
+            )
+
+def create_user_store():
+    """Создание хранилища настроек по переменной USER_STORE"""
+    if USER_STORE == "json":
+        return JsonUserStore(USER_DATA_FILE)
+    return SqliteUserStore(USER_DB_FILE)
+
+# Загрузка данных пользователей из хранилища
+def load_user_data():
+    try:
+        data = user_store.load()
+        # Перенос данных из старого JSON-файла при первом запуске с SQLite
+        if not data and isinstance(user_store, SqliteUserStore) and os.path.exists(USER_DATA_FILE):
+            data = JsonUserStore(USER_DATA_FILE).load()
+            user_store.write(data, [])
+            logging.info(f"Перенесено пользователей из {USER_DATA_FILE}: {len(data)}")
+    except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+        logging.warning(f"Ошибка загрузки данных: {e}")
+        return {}
+    # Обновляем старые данные, добавляя недостающие поля
+    for user_id, user_info in data.items():
+        data[user_id] = {**DEFAULT_USER_DATA, **user_info}
+    return data
+
+# Отметка изменений пользователя с отложенной записью
+def save_user_data(user_id):
+    global flush_scheduled
+    dirty_users.add(user_id)
+    if flush_scheduled:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Вне event loop записываем сразу
+        write_user_data(*collect_dirty_users())
+        return
+    flush_scheduled = True
+    loop.call_later(USER_DATA_FLUSH_DELAY, lambda: asyncio.ensure_future(flush_user_data()))
+
+def collect_dirty_users():
+    """Снимок изменённых и удалённых пользователей"""
+    changed = {
+        user_id: dict(user_data[user_id]) for user_id in dirty_users if user_id in user_data
+    }
+    deleted = [user_id for user_id in dirty_users if user_id not in user_data]
+    dirty_users.clear()
+    return changed, deleted
+
+def write_user_data(changed, deleted):
+    if not changed and not deleted:
+        return
     try:
-        with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except IOError as e:
+        user_store.write(changed, deleted)
+    except (IOError, sqlite3.Error) as e:
         logging.error(f"Ошибка сохранения данных: {e}")
 
+async def flush_user_data():
+    """Запись накопленных изменений в отдельном потоке"""
+    global flush_scheduled
+    flush_scheduled = False
+    # Блокировка сохраняет порядок записей
+    async with flush_lock:
+        changed, deleted = collect_dirty_users()
+        await asyncio.get_running_loop().run_in_executor(
+            None, write_user_data, changed, deleted
+        )
+
+class ContextMemory(MutableMapping):
+    """История диалогов с сохранением между перезапусками.
+    Активные диалоги держатся в памяти (LRU + TTL), остальные лежат в SQLite
+    и загружаются при следующем обращении. Изменения пишутся отложенно"""
+
+    def __init__(self, path, max_size, ttl):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS context (user_id TEXT PRIMARY KEY, messages TEXT NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hot = OrderedDict()  # user_id -> [история, время последнего обращения]
+        self.pending = {}  # user_id -> история (None - удаление), ожидающие записи
+        self.writing = {}  # Истории, которые записываются прямо сейчас
+        self.flush_scheduled = False
+        self.flush_lock = asyncio.Lock()
+
+    def _load(self, user_id):
+        """История из памяти или с диска без отметки об изменении"""
+        if user_id in self.hot:
+            entry = self.hot[user_id]
+            entry[1] = time.monotonic()
+            self.hot.move_to_end(user_id)
+            return entry[0]
+        if user_id in self.pending:
+            history = self.pending[user_id]
+        elif user_id in self.writing:
+            history = self.writing[user_id]
+        else:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT messages FROM context WHERE user_id = ?", (user_id,)
+                ).fetchone()
+            history = deque(json.loads(row[0])) if row else None
+        if history is not None:
+            self.hot[user_id] = [history, time.monotonic()]
+            self._evict()
+        return history
+
+    def _evict(self):
+        """Вытеснение самых старых диалогов из памяти (несохранённые остаются в pending)"""
+        expire_before = time.monotonic() - self.ttl
+        while self.hot:
+            user_id, (_, last_access) = next(iter(self.hot.items()))
+            if len(self.hot) <= self.max_size and last_access >= expire_before:
+                break
+            del self.hot[user_id]
+
+    def _mark_dirty(self, user_id, history):
+        self.pending[user_id] = history
+        if self.flush_scheduled:
+            return
+        self.flush_scheduled = True
+        asyncio.get_running_loop().call_later(
+            USER_DATA_FLUSH_DELAY, lambda: asyncio.ensure_future(self.flush())
+        )
+
+    def __contains__(self, user_id):
+        return self._load(user_id) is not None
+
+    def __getitem__(self, user_id):
+        history = self._load(user_id)
+        if history is None:
+            raise KeyError(user_id)
+        # История меняется на месте, поэтому любое обращение считается изменением
+        self._mark_dirty(user_id, history)
+        return history
+
+    def __setitem__(self, user_id, history):
+        self.hot[user_id] = [history, time.monotonic()]
+        self.hot.move_to_end(user_id)
+        self._evict()
+        self._mark_dirty(user_id, history)
+
+    def __delitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self.hot.pop(user_id, None)
+        self._mark_dirty(user_id, None)
+
+    def __iter__(self):
+        with self.lock:
+            stored = {row[0] for row in self.conn.execute("SELECT user_id FROM context")}
+        stored |= self.hot.keys()
+        stored |= {user_id for user_id, history in self.pending.items() if history is not None}
+        stored -= {user_id for user_id, history in self.pending.items() if history is None}
+        return iter(stored)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _write(self, snapshot):
+        try:
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "INSERT INTO context (user_id, messages) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET messages = excluded.messages",
+                    [(user_id, data) for user_id, data in snapshot.items() if data is not None],
+                )
+                self.conn.executemany(
+                    "DELETE FROM context WHERE user_id = ?",
+                    [(user_id,) for user_id, data in snapshot.items() if data is None],
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка сохранения контекста: {e}")
+
+    async def flush(self):
+        """Запись изменённых историй в отдельном потоке"""
+        self.flush_scheduled = False
+        async with self.flush_lock:
+            self.writing, self.pending = self.pending, {}
+            snapshot = {
+                user_id: None if history is None else json.dumps(list(history), ensure_ascii=False)
+                for user_id, history in self.writing.items()
+            }
+            try:
+                if snapshot:
+                    await asyncio.get_running_loop().run_in_executor(None, self._write, snapshot)
+            finally:
+                self.writing = {}
+
+class ResponseCache:
+    """LRU-кэш результатов по ключу из содержимого запроса.
+    Второй уровень (по желанию) - таблица SQLite, работа с ней в отдельном потоке.
+    На диске хранится не больше disk_size записей не старше ttl секунд"""
+
+    def __init__(self, name, max_size, path, disk_size, ttl):
+        self.name = name
+        self.max_size = max_size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "created REAL NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({name})")]
+            if "created" not in columns:
+                # Таблица из прежней версии: записи без времени удалятся при первой очистке
+                self.conn.execute(f"ALTER TABLE {name} ADD COLUMN created REAL NOT NULL DEFAULT 0")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_created ON {name} (created)")
+            self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """Ключ кэша из частей запроса"""
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def _disk_get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT value FROM {self.name} WHERE key = ? AND created >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _disk_put(self, key, value):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, created) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            # Просроченные записи и самые старые сверх disk_size
+            self.conn.execute(f"DELETE FROM {self.name} WHERE created < ?", (now - self.ttl,))
+            self.conn.execute(
+                f"DELETE FROM {self.name} WHERE key IN (SELECT key FROM {self.name} "
+                "ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.disk_size,),
+            )
+
+    async def get(self, key):
+        value = self.items.get(key)
+        if value is None and self.conn:
+            value = await asyncio.to_thread(self._disk_get, key)
+            if value is not None:
+                self._remember(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.items.move_to_end(key)
+            self.hits += 1
+        return value
+
+    async def put(self, key, value):
+        self._remember(key, value)
+        if self.conn:
+            await asyncio.to_thread(self._disk_put, key, value)
+
+# Кэш ответов по картинкам и кэш сгенерированных изображений
+answer_cache = ResponseCache(
+    "answers", ANSWER_CACHE_SIZE, RESPONSE_CACHE_DB, ANSWER_CACHE_DB_SIZE, RESPONSE_CACHE_TTL
+)
+image_cache = ResponseCache(
+    "images", IMAGE_CACHE_SIZE, RESPONSE_CACHE_DB, IMAGE_CACHE_DB_SIZE, RESPONSE_CACHE_TTL
+)
+
+class SemanticCache:
+    """Кэш ответов по смыслу вопроса.
+    Нормированные эмбеддинги вопросов лежат в матрице NumPy, поиск - скалярное
+    произведение с записями той же области (модель, системный промт, режим).
+    Вытеснение по TTL и LRU, записи по желанию сохраняются в SQLite.
+    embed - асинхронная функция текст -> вектор, её можно подменить"""
+
+    def __init__(self, embed, max_size, ttl, threshold, path=""):
+        self.name = "semantic"
+        self.embed = embed
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.vectors = None  # (max_size, размерность), создаётся по первому эмбеддингу
+        self.scopes = np.zeros(max_size, dtype=np.int64)
+        self.created = np.zeros(max_size)  # Время записи (time.time), 0 - пустое место
+        self.used = np.zeros(max_size)  # Время последнего попадания для LRU
+        self.keys = [None] * max_size
+        self.answers = [None] * max_size
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS semantic (key TEXT PRIMARY KEY, scope INTEGER NOT NULL, "
+                "answer TEXT NOT NULL, vector BLOB NOT NULL, created REAL NOT NULL)"
+            )
+            self.lock = threading.Lock()
+            self._load()
+
+    @staticmethod
+    def scope_id(*parts):
+        """Числовой идентификатор области поиска"""
+        return int(ResponseCache.make_key(*parts)[:15], 16)
+
+    def _load(self):
+        """Загрузка свежих записей из SQLite"""
+        expired = time.time() - self.ttl
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM semantic WHERE created < ?", (expired,))
+            rows = self.conn.execute(
+                "SELECT key, scope, answer, vector, created FROM semantic "
+                "ORDER BY created DESC LIMIT ?",
+                (self.max_size,),
+            ).fetchall()
+        for key, scope, answer, vector, created in rows:
+            self._store(self._free_slot(), key, scope, np.frombuffer(vector, dtype=np.float32), answer, created)
+
+    def _free_slot(self):
+        """Пустое или просроченное место, иначе давно не использованная запись"""
+        expired = time.time() - self.ttl
+        slot = int(np.argmin(self.created))
+        if self.created[slot] >= expired:
+            slot = int(np.argmin(self.used))
+        return slot
+
+    def _store(self, slot, key, scope, vector, answer, created):
+        if self.vectors is None:
+            self.vectors = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+        self.vectors[slot] = vector
+        self.scopes[slot] = scope
+        self.created[slot] = self.used[slot] = created
+        self.keys[slot] = key
+        self.answers[slot] = answer
+
+    async def get(self, scope, question):
+        """Поиск похожего вопроса. Возвращает (ответ или None, эмбеддинг вопроса)"""
+        try:
+            vector = np.asarray(await self.embed(question), dtype=np.float32)
+        except Exception as e:
+            logging.warning(f"Не удалось получить эмбеддинг: {e}")
+            return None, None
+        vector /= np.linalg.norm(vector) or 1.0
+        if self.vectors is not None and self.vectors.shape[1] == len(vector):
+            now = time.time()
+            candidates = np.flatnonzero(
+                (self.scopes == scope) & (self.created >= now - self.ttl)
+            )
+            if len(candidates):
+                scores = self.vectors[candidates] @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    slot = candidates[best]
+                    self.used[slot] = now
+                    self.hits += 1
+                    metrics.inc("semantic_cache_requests_total", result="hit")
+                    return self.answers[slot], vector
+        self.misses += 1
+        metrics.inc("semantic_cache_requests_total", result="miss")
+        return None, vector
+
+    async def put(self, scope, question, vector, answer):
+        """Сохранение ответа на вопрос с уже посчитанным эмбеддингом"""
+        if vector is None:
+            return
+        key = ResponseCache.make_key(scope, question)
+        if self.vectors is not None and self.vectors.shape[1] != len(vector):
+            # Сменилась модель эмбеддингов - старый индекс несовместим
+            self.vectors = None
+            self.created[:] = 0
+        if key in self.keys:
+            slot = self.keys.index(key)
+        else:
+            slot = self._free_slot()
+        evicted = self.keys[slot]
+        self._store(slot, key, scope, vector, answer, time.time())
+        if self.conn:
+            await asyncio.to_thread(self._disk_put, evicted, key, scope, vector, answer)
+
+    def _disk_put(self, evicted, key, scope, vector, answer):
+        with self.lock, self.conn:
+            if evicted and evicted != key:
+                self.conn.execute("DELETE FROM semantic WHERE key = ?", (evicted,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO semantic (key, scope, answer, vector, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, scope, answer, vector.astype(np.float32).tobytes(), time.time()),
+            )
+
+async def embed_with_ollama(text):
+    """Эмбеддинг текста моделью SEMANTIC_CACHE_MODEL"""
+    response = await ollama_client.embed(model=SEMANTIC_CACHE_MODEL, input=text)
+    return response["embeddings"][0]
+
+# Семантический кэш ответов (None - выключен) и все кэши для статистики
+semantic_cache = (
+    SemanticCache(
+        embed_with_ollama,
+        SEMANTIC_CACHE_SIZE,
+        SEMANTIC_CACHE_TTL,
+        SEMANTIC_CACHE_THRESHOLD,
+        SEMANTIC_CACHE_DB,
+    )
+    if SEMANTIC_CACHE
+    else None
+)
+caches = tuple(cache for cache in (answer_cache, image_cache, semantic_cache) if cache)
+
+def new_history(system_prompt):
+    """Новая история диалога, первым всегда идёт системный промт"""
+    return deque([{"role": "system", "content": system_prompt}])
+
+def message_tokens(message):
+    """Оценка числа токенов сообщения, кэшируется в самом сообщении"""
+    if "tokens" not in message:
+        message["tokens"] = len(message["content"]) // CHARS_PER_TOKEN + 4
+    return message["tokens"]
+
+def token_budget(model_key):
+    """Бюджет токенов истории для модели"""
+    return MODEL_NUM_CTX[model_key] - ANSWER_TOKEN_RESERVE
+
+def trim_history(history, max_messages, budget):
+    """Удаление старых сообщений при превышении лимита сообщений или токенов.
+    История сокращается сразу до доли HISTORY_TRIM_TARGET от лимитов, а не на одно
+    сообщение за ход, чтобы Ollama могла переиспользовать обработанное начало промта.
+    После системного промта история начинается с сообщения пользователя.
+    Системный промт и последнее сообщение не удаляются; если последнее сообщение
+    само не помещается в бюджет, из его середины вырезается лишнее.
+    Возвращает True, если последнее сообщение было обрезано"""
+    total = sum(message_tokens(message) for message in history)
+    if len(history) <= max_messages and total <= budget:
+        return False
+    limit = budget
+    max_messages = max(2, int(max_messages * HISTORY_TRIM_TARGET))
+    budget *= HISTORY_TRIM_TARGET
+    system = history.popleft()
+    while len(history) > 1 and (
+        len(history) + 1 > max_messages or total > budget or history[0]["role"] != "user"
+    ):
+        total -= message_tokens(history.popleft())
+    history.appendleft(system)
+    if total <= limit:
+        return False
+    # Иначе Ollama сама отбросит начало промта вместе с системным
+    last = history[-1]
+    content = last["content"]
+    keep = max(0, len(content) - (total - limit) * CHARS_PER_TOKEN - len(TRUNCATION_MARK))
+    last["content"] = content[:keep // 2] + TRUNCATION_MARK + content[len(content) - (keep - keep // 2):]
+    del last["tokens"]
+    return True
+
+class TranscriptionQueue:
+    """Очередь распознавания речи в пуле потоков.
+    Задания разных пользователей выбираются по кругу, длина очереди ограничена.
+    Задания, пришедшие в пределах окна batch_window, обрабатываются одним пакетом"""
+
+    def __init__(self, batch_func, workers, max_size, batch_size, batch_window):
+        self.batch_func = batch_func
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+        self.workers = workers
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queues = OrderedDict()  # user_id -> задания; порядок ключей - порядок обхода
+        self.size = 0  # Заданий в ожидании
+        self.active = 0  # Пакетов в работе
+        self.dispatch_scheduled = False
+
+    def full(self):
+        return self.size >= self.max_size
+
+    def position(self, user_id):
+        """Примерное число заданий, которые будут выполнены раньше нового задания пользователя"""
+        own = len(self.queues.get(user_id, ()))
+        others = sum(
+            min(len(jobs), own + 1) for key, jobs in self.queues.items() if key != user_id
+        )
+        return own + others
+
+    async def submit(self, user_id, item, on_start=None, reserved=False):
+        """Постановка задания в очередь и ожидание результата.
+        reserved - место в очереди уже проверено вызывающим"""
+        if self.full() and not reserved:
+            raise asyncio.QueueFull
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queues.setdefault(user_id, deque()).append((item, future, on_start, time.monotonic()))
+        self.size += 1
+        # Даём собраться пакету перед запуском
+        if not self.dispatch_scheduled:
+            self.dispatch_scheduled = True
+            loop.call_later(self.batch_window, self._dispatch)
+        return await future
+
+    def _next_batch(self):
+        """Выбор до batch_size заданий по кругу между пользователями"""
+        batch = []
+        while self.queues and len(batch) < self.batch_size:
+            user_id, jobs = next(iter(self.queues.items()))
+            job = jobs.popleft()
+            # Пользователь уходит в конец круга
+            del self.queues[user_id]
+            if jobs:
+                self.queues[user_id] = jobs
+            self.size -= 1
+            if not job[1].cancelled():
+                batch.append(job)
+        return batch
+
+    def _dispatch(self):
+        """Запуск пакетов на свободных воркерах"""
+        self.dispatch_scheduled = False
+        loop = asyncio.get_running_loop()
+        while self.active < self.workers and self.queues:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            self.active += 1
+            now = time.monotonic()
+            metrics.observe("voice_batch_size", len(batch))
+            for _, _, on_start, enqueued in batch:
+                metrics.observe("voice_queue_wait_seconds", now - enqueued)
+                if on_start:
+                    asyncio.ensure_future(on_start())
+            task = loop.run_in_executor(
+                self.executor, self.batch_func, [item for item, _, _, _ in batch]
+            )
+            task.add_done_callback(lambda done, batch=batch: self._finish(done, batch))
+
+    def _finish(self, done, batch):
+        self.active -= 1
+        futures = [future for _, future, _, _ in batch]
+        if done.exception():
+            results = [done.exception()] * len(futures)
+        else:
+            results = done.result()
+        for future, result in zip(futures, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self._dispatch()
+
+whisper_model = None  # Модель распознавания речи, загружается лениво
+whisper_lock = threading.Lock()
+whisper_last_used = 0.0
+
+def get_whisper_model():
+    """Модель распознавания речи с загрузкой при первом обращении (вызывается из пула потоков)"""
+    global whisper_model, whisper_last_used
+    with whisper_lock:
+        if whisper_model is None:
+            started = time.monotonic()
+            whisper_model = WhisperModel(
+                WHISPER_MODEL,
+                device="cpu",
+                compute_type=WHISPER_COMPUTE_TYPE,
+                cpu_threads=WHISPER_THREADS,
+                num_workers=WHISPER_WORKERS,
+            )
+            logging.info(
+                f"Модель Whisper {WHISPER_MODEL} загружена за {time.monotonic() - started:.1f} с"
+            )
+        whisper_last_used = time.monotonic()
+        return whisper_model
+
+async def unload_idle_whisper():
+    """Периодическая выгрузка модели распознавания речи после простоя"""
+    global whisper_model
+    while True:
+        await asyncio.sleep(WHISPER_IDLE_UNLOAD / 2)
+        # Блокировку держит загрузка модели: ждать её в цикле событий нельзя,
+        # модель сейчас нужна, проверка переносится на следующий раз
+        if not whisper_lock.acquire(blocking=False):
+            continue
+        try:
+            idle = time.monotonic() - whisper_last_used
+            if whisper_model is not None and voice_queue.active == 0 and idle >= WHISPER_IDLE_UNLOAD:
+                whisper_model = None
+                logging.info("Модель Whisper выгружена после простоя")
+        finally:
+            whisper_lock.release()
+
+def load_audio(voice):
+    """Аудио как 16 кГц моно float32: уже декодированный кусок или байты Opus"""
+    if isinstance(voice, np.ndarray):
+        return voice
+    # Opus -> 16 кГц моно float32 без временных файлов
+    return decode_audio(io.BytesIO(voice), sampling_rate=16000)
+
+def transcribe_voice(voice):
+    """Декодирование и распознавание голосового сообщения в памяти (выполняется в пуле потоков)"""
+    audio = load_audio(voice)
+    segments, _ = get_whisper_model().transcribe(
+        audio, language="ru", beam_size=5, vad_filter=True
+    )
+    # Сегменты ленивые, распознавание идёт при их обходе
+    return " ".join([segment.text for segment in segments])
+
+def speech_clips(audio, offset, sampling_rate=16000, max_duration=30):
+    """Участки речи (в секундах от начала пакета), склеенные в куски до max_duration"""
+    clips = []
+    vad = VadOptions(max_speech_duration_s=max_duration, min_silence_duration_ms=160)
+    for speech in get_speech_timestamps(audio, vad):
+        start = offset + speech["start"] / sampling_rate
+        end = offset + speech["end"] / sampling_rate
+        if clips and end - clips[-1]["start"] <= max_duration:
+            clips[-1]["end"] = end
+        else:
+            clips.append({"start": start, "end": end})
+    return clips
+
+def split_voice(voice_bytes, max_duration=LONG_VOICE_CHUNK):
+    """Декодирование длинного голосового и разрезание по паузам на куски до max_duration сек
+    (выполняется в пуле потоков)"""
+    audio = decode_audio(io.BytesIO(voice_bytes), sampling_rate=16000)
+    return [
+        audio[int(clip["start"] * 16000):int(clip["end"] * 16000)]
+        for clip in speech_clips(audio, 0, max_duration=max_duration)
+    ]
+
+def transcribe_batch(voices):
+    """Пакетное распознавание нескольких голосовых сообщений (выполняется в пуле потоков).
+    Аудио склеиваются через паузу, участки речи всех сообщений идут через
+    BatchedInferencePipeline одним пакетом, затем сегменты раздаются по сообщениям"""
+    if len(voices) == 1:
+        try:
+            return [transcribe_voice(voices[0])]
+        except Exception as e:
+            return [e]
+    results = [None] * len(voices)
+    audios, bounds, clips = [], [], []
+    gap = np.zeros(16000, dtype=np.float32)  # Секунда тишины между сообщениями
+    offset = 0.0
+    for i, voice in enumerate(voices):
+        try:
+            audio = load_audio(voice)
+        except Exception as e:
+            results[i] = e
+            continue
+        bounds.append((i, offset, offset + len(audio) / 16000))
+        clips.extend(speech_clips(audio, offset))
+        audios.extend([audio, gap])
+        offset += (len(audio) + len(gap)) / 16000
+    texts = {i: [] for i, _, _ in bounds}
+    if clips:
+        pipeline = BatchedInferencePipeline(get_whisper_model())
+        segments, _ = pipeline.transcribe(
+            np.concatenate(audios),
+            language="ru",
+            beam_size=5,
+            clip_timestamps=clips,
+        )
+        for segment in segments:
+            for i, start, end in bounds:
+                if start <= segment.start < end:
+                    texts[i].append(segment.text)
+                    break
+    for i, _, _ in bounds:
+        results[i] = " ".join(texts[i])
+    return results
+
+class UpdateSlot:
+    """Слот обработки обновления.
+    На время ожидания очередей моделей и распознавания слот отдаётся другим
+    обновлениям, чтобы долгие запросы не задерживали короткие команды"""
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.held = False
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        self.held = True
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+    @asynccontextmanager
+    async def released(self):
+        """Временное освобождение слота с возвратом после выхода из блока"""
+        if not self.held:
+            yield
+            return
+        self._release()
+        try:
+            yield
+        finally:
+            # При отмене во время ожидания слот не получен и не будет освобождён
+            await self.semaphore.acquire()
+            self.held = True
+
+# Слот обновления, которое обрабатывается в текущей задаче
+update_slot = contextvars.ContextVar("update_slot", default=None)
+
+@asynccontextmanager
+async def outside_update_slot():
+    """Ожидание внешней очереди (модели, распознавания) без занятого слота обработки"""
+    slot = update_slot.get()
+    if slot is None:
+        yield
+        return
+    async with slot.released():
+        yield
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя
+
+    Обновления одного пользователя выполняются строго друг за другом (история,
+    настройки и генерации хранятся по пользователю, даже если он пишет в
+    нескольких чатах), разные пользователи обрабатываются одновременно. Слот
+    обработки берётся только после блокировки пользователя, поэтому его очередь
+    не занимает слоты остальных, а пока обработчик ждёт модель или распознавание,
+    слот свободен (см. UpdateSlot). Семафор базового класса ограничивает число
+    ожидающих обновлений. /stop выполняется сразу, вне очереди и без слота
+    обработки, а /clear, /clearc и новые сообщения останавливают текущую
+    генерацию ещё до того, как встанут в очередь.
+    """
+
+    def __init__(self, max_concurrent_updates, backlog=UPDATE_BACKLOG):
+        super().__init__(max(backlog, max_concurrent_updates))
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.locks = {}  # ключ очереди -> [блокировка, число обновлений в очереди]
+
+    async def do_process_update(self, update, coroutine):
+        key = ordering_key(update)
+        command = update_command(update) if key else None
+        if command == "stop":
+            # Слоты могут быть заняты теми самыми генерациями, которые нужно остановить
+            await coroutine
+            return
+        if key is None:
+            await self._run(coroutine)
+            return
+        preempt_generation(update, command)
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    async def _run(self, coroutine):
+        """Выполнение обработчика в слоте, доступном ему через update_slot"""
+        slot = UpdateSlot(self.slots)
+        token = update_slot.set(slot)
+        try:
+            async with slot:
+                await coroutine
+        finally:
+            update_slot.reset(token)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def ordering_key(update):
+    """Ключ очереди обновления: пользователь, а для обновлений без него - чат"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return ("user", update.effective_user.id)
+    if update.effective_chat:
+        return ("chat", update.effective_chat.id)
+    return None
+
+def update_command(update):
+    """Имя команды из сообщения (без / и @имени бота) или None"""
+    message = update.message
+    if not message or not message.text or not message.text.startswith("/"):
+        return None
+    return message.text.split()[0][1:].split("@")[0].lower()
+
+def preempt_generation(update, command):
+    """Остановка генерации, которую обновление всё равно сделает ненужной"""
+    if not update.effective_user:
+        return
+    if command in ("clear", "clearc"):
+        cancel_generation(str(update.effective_user.id))
+    elif SUPERSEDE_PENDING and command is None and update.message:
+        message = update.message
+        if message.text or message.voice or message.photo:
+            cancel_generation(str(update.effective_user.id))
+
+async def on_startup(application):
+    """Фоновые задачи после запуска бота"""
+    global sd_session, metrics_runner
+    # Общий пул соединений к Stable Diffusion
+    sd_session = aiohttp.ClientSession(
+        base_url=SD_URL, connector=aiohttp.TCPConnector(limit=SD_CONCURRENCY + 2)
+    )
+    if METRICS_PORT:
+        # Каждый процесс-обработчик слушает свой порт: METRICS_PORT + номер процесса
+        port = METRICS_PORT + worker_index
+        metrics_app = web.Application()
+        metrics_app.router.add_get("/metrics", serve_metrics)
+        metrics_runner = web.AppRunner(metrics_app, access_log=None)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+        logging.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+    logging.info(f"Бот готов к работе через {time.monotonic() - STARTED_AT:.1f} с после запуска")
+    loop = asyncio.get_running_loop()
+    if WHISPER_WARMUP:
+        loop.run_in_executor(voice_queue.executor, get_whisper_model)
+    if WHISPER_IDLE_UNLOAD > 0:
+        background_tasks.add(asyncio.ensure_future(unload_idle_whisper()))
+
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Замер времени от запуска до обработки первого обновления"""
+    global first_update_seen
+    if not first_update_seen:
+        first_update_seen = True
+        logging.info(f"Первое обновление обработано через {time.monotonic() - STARTED_AT:.1f} с после запуска")
+
+async def on_shutdown(application):
+    """Сохранение несохранённых данных при остановке"""
+    await flush_user_data()
+    await context_memory.flush()
+    for task in background_tasks:
+        task.cancel()
+    if sd_session:
+        await sd_session.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    voice_queue.executor.shutdown(wait=False, cancel_futures=True)
+
 # Инициализация хранилища данных
+user_store = create_user_store()
 user_data = load_user_data()  # Сессии пользователей
-context_memory = {}  # История сообщений
+dirty_users = set()  # Пользователи с незаписанными изменениями
+flush_scheduled = False
+flush_lock = asyncio.Lock()
+context_memory = ContextMemory(CONTEXT_DB_FILE, CONTEXT_CACHE_SIZE, CONTEXT_TTL)  # История сообщений
+voice_queue = TranscriptionQueue(
+    transcribe_batch, WHISPER_WORKERS, VOICE_QUEUE_SIZE, VOICE_BATCH_SIZE, VOICE_BATCH_WINDOW
+)  # Очередь распознавания речи
+background_tasks = set()  # Фоновые задачи бота
+sd_session = None  # Сессия aiohttp к Stable Diffusion, создаётся при запуске
+sd_semaphore = asyncio.Semaphore(SD_CONCURRENCY)  # Ограничение одновременных генераций
+sd_jobs = 0  # Генераций в очереди и в работе
+generations = {}  # user_id -> задача текущей генерации ответа
+sd_models_checked_at = None  # Время последней успешной проверки моделей SD
+first_update_seen = False
+metrics_runner = None  # HTTP-сервер метрик
+worker_index = 0  # Номер процесса-обработчика
+worker_queues = []  # Очереди обновлений процессов-обработчиков (в основном процессе)
+worker_processes = []
+gateway = None  # Доступ к общим очередям Ollama и SD (в процессе-обработчике)
+gateway_requests = None  # Запросы мест от обработчиков (в основном процессе)
+gateway_task = None
 
 def ensure_user_data(user_id):
-    """Обеспечивает наличие всех необходимых полей в данных пользователя"""
-    if user_id not in user_data:
-        user_data[user_id] = DEFAULT_USER_DATA.copy()
-        save_user_data(user_data)
-    else:
-        # Добавляем отсутствующие поля
-        for key, value in DEFAULT_USER_DATA.items():
-            if key not in user_data[user_id]:
-                user_data[user_id][key] = value
-        save_user_data(user_data)
-    return user_data[user_id]
+    """Данные пользователя из памяти, новый пользователь получает настройки по умолчанию.
+    Недостающие поля старых записей добавляются при загрузке (load_user_data)"""
+    user = user_data.get(user_id)
+    if user is None:
+        user = user_data[user_id] = DEFAULT_USER_DATA.copy()
+        save_user_data(user_id)
+    return user
+
+def split_point(text, start):
+    """Позиция разбиения длинного текста: по переводу строки, если он не слишком далеко"""
+    end = start + TELEGRAM_MESSAGE_LIMIT
+    newline = text.rfind("\n", start, end)
+    if newline > start + TELEGRAM_MESSAGE_LIMIT // 2:
+        return newline + 1
+    return end
+
+async def edit_message(message, text):
+    """Редактирование сообщения с учётом лимитов Telegram.
+    Возвращает True, если сработало ограничение частоты"""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        delay = e.retry_after
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        await asyncio.sleep(delay)
+        await message.edit_text(text)
+        return True
+    except BadRequest as e:
+        # Текст не изменился - не ошибка
+        if "not modified" not in str(e).lower():
+            raise
+    return False
+
+async def stream_reply(message, stream, prefix=""):
+    """Отправка ответа модели по мере генерации.
+    Сначала отправляется заглушка, затем она редактируется не чаще STREAM_EDIT_INTERVAL,
+    при превышении лимита Telegram текст продолжается в новом сообщении"""
+    interval = STREAM_EDIT_INTERVAL
+    if message.chat.type != "private":
+        interval *= 3  # В группах лимиты на редактирование строже
+    sent = await message.reply_text(prefix + "⏳")
+    content = ""
+    shown = prefix + "⏳"  # Текст, отображаемый в текущем сообщении
+    start = 0  # Начало текущего сообщения в полном тексте
+    last_edit = time.monotonic()
+    chunk = None
+    started = time.monotonic()
+    try:
+        async for chunk in stream:
+            if not content and chunk["message"]["content"]:
+                metrics.observe("llm_first_token_seconds", time.monotonic() - started)
+            content += chunk["message"]["content"]
+            full = prefix + content
+            # Переход к новому сообщению при достижении лимита длины
+            while len(full) - start > TELEGRAM_MESSAGE_LIMIT:
+                cut = split_point(full, start)
+                await edit_message(sent, full[start:cut])
+                start = cut
+                shown = full[start:start + TELEGRAM_MESSAGE_LIMIT].strip() or "⏳"
+                sent = await message.reply_text(shown)
+                last_edit = time.monotonic()
+            # Периодическое обновление текущего сообщения
+            if time.monotonic() - last_edit >= interval and full[start:].strip():
+                if full[start:] != shown:
+                    shown = full[start:]
+                    if await edit_message(sent, shown):
+                        interval *= 2  # Telegram просит реже - замедляемся
+                    last_edit = time.monotonic()
+    except asyncio.CancelledError:
+        # Закрытие потока обрывает соединение, и Ollama сразу прекращает генерацию
+        await stream.aclose()
+        # Уже показанный текст остаётся с пометкой об остановке
+        stopped = (prefix + content)[start:][:TELEGRAM_MESSAGE_LIMIT - 20].strip()
+        await edit_message(sent, f"{stopped}\n\n⏹ Остановлено".strip())
+        raise
+    # Финальное состояние сообщения
+    final = (prefix + content)[start:]
+    if not final.strip():
+        final = "⚠️ Пустой ответ модели"
+    if final != shown:
+        await edit_message(sent, final)
+    return content, chunk
+
+class ModelScheduler:
+    """Планировщик запросов к Ollama.
+    Ограничивает число параллельных запросов на модель и число одновременно
+    загруженных моделей. Пока модель загружена, запросы к ней идут без очереди
+    к другим моделям, чтобы Ollama реже перезагружала веса. Переключение
+    происходит, когда запросы текущей модели закончились или другая модель
+    ждёт дольше switch_after. Внутри модели очередь по приоритету и времени"""
+
+    def __init__(self, concurrency, max_loaded, switch_after, keep_alive):
+        self.concurrency = concurrency
+        self.max_loaded = max_loaded
+        self.switch_after = switch_after
+        self.default_keep_alive = keep_alive  # model -> keep_alive
+        self.running = {}  # model -> запросов в работе
+        self.waiting = {}  # model -> куча (приоритет, номер, время постановки, future)
+        self.counter = itertools.count()
+        self.recent = deque(maxlen=max_loaded)  # Последние модели, скорее всего ещё в памяти
+        self.waits = {}  # model -> [число запросов, суммарное ожидание, последнее ожидание]
+
+    def _can_start(self, model):
+        if self.running.get(model, 0) >= self.concurrency:
+            return False
+        loaded = [name for name, count in self.running.items() if count > 0]
+        return model in loaded or len(loaded) < self.max_loaded
+
+    def _waiting(self, model):
+        """Ожидающие запросы к модели без отменённых, ещё не убранных из кучи"""
+        return [entry for entry in self.waiting.get(model, ()) if not entry[3].cancelled()]
+
+    def _starving(self, now):
+        """Незагруженные модели, которые ждут дольше switch_after"""
+        starving = set()
+        for model in self.waiting:
+            entries = self._waiting(model)
+            if (
+                entries
+                and not self.running.get(model)
+                and now - min(entry[2] for entry in entries) >= self.switch_after
+            ):
+                starving.add(model)
+        return starving
 
+    def _wake(self):
+        """Запуск ожидающих запросов на освободившиеся места"""
+        while True:
+            now = time.monotonic()
+            starving = self._starving(now)
+            candidates = [
+                (heap[0][:2], model)
+                for model, heap in self.waiting.items()
+                if heap and self._can_start(model)
+            ]
+            if starving:
+                # Загруженные модели не принимают новые запросы, пока не освободятся
+                candidates = [item for item in candidates if item[1] in starving]
+            else:
+                warm = [
+                    item
+                    for item in candidates
+                    if self.running.get(item[1]) or item[1] in self.recent
+                ]
+                candidates = warm or candidates
+            if not candidates:
+                return
+            _, model = min(candidates)
+            _, _, enqueued, future = heapq.heappop(self.waiting[model])
+            if future.cancelled():
+                continue
+            self.running[model] = self.running.get(model, 0) + 1
+            if model not in self.recent:
+                self.recent.append(model)
+            stats = self.waits.setdefault(model, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += now - enqueued
+            stats[2] = now - enqueued
+            metrics.observe("llm_queue_wait_seconds", now - enqueued, model=model)
+            future.set_result(None)
+
+    def _release(self, model):
+        self.running[model] -= 1
+        self._wake()
+
+    def _forget(self, model, entry):
+        """Удаление отменённого запроса из очереди"""
+        heap = self.waiting[model]
+        if entry in heap:
+            heap.remove(entry)
+            heapq.heapify(heap)
+        self._wake()
+
+    def keep_alive(self, model):
+        """Подсказка Ollama: выгрузить модель сразу, если её ждать некому, а другие ждут"""
+        others_waiting = any(self._waiting(name) for name in self.waiting if name != model)
+        if others_waiting and not self._waiting(model):
+            return 0
+        return self.default_keep_alive.get(model, LLM_KEEP_ALIVE)
+
+    @asynccontextmanager
+    async def slot(self, model, priority=PRIORITY_TEXT):
+        """Ожидание места для запроса к модели, возвращает keep_alive для запроса"""
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.counter), time.monotonic(), future)
+        heapq.heappush(self.waiting.setdefault(model, []), entry)
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(model)
+            else:
+                self._forget(model, entry)
+            raise
+        try:
+            yield self.keep_alive(model)
+        finally:
+            self._release(model)
+
+    def stats(self):
+        """Глубина очереди и время ожидания по моделям"""
+        return {
+            model: {
+                "running": self.running.get(model, 0),
+                "waiting": len(self._waiting(model)),
+                "avg_wait": self.waits[model][1] / self.waits[model][0] if model in self.waits else 0.0,
+                "last_wait": self.waits[model][2] if model in self.waits else 0.0,
+            }
+            for model in MODELS.values()
+        }
+
+# Планировщик запросов к Ollama
+llm_scheduler = ModelScheduler(
+    LLM_CONCURRENCY,
+    LLM_MAX_LOADED_MODELS,
+    LLM_SWITCH_AFTER,
+    {MODELS[key]: keep_alive for key, keep_alive in MODEL_KEEP_ALIVE.items()},
+)
+
+# Имя очереди Stable Diffusion в общих очередях процессов
+SD_RESOURCE = "sd"
+
+class GatewayClient:
+    """Места в общих очередях Ollama и SD, которые выдаёт основной процесс.
+    Повторяет интерфейс ModelScheduler и подменяет llm_scheduler в процессе-обработчике.
+    Сами запросы к Ollama и SD процесс-обработчик выполняет сам"""
+
+    def __init__(self, index, requests, replies):
+        self.index = index
+        self.requests = requests  # Общая очередь запросов к основному процессу
+        self.replies = replies  # Ответы основного процесса этому обработчику
+        self.counter = itertools.count()
+        self.pending = {}  # номер запроса -> future с keep_alive
+        self.llm_stats = {
+            model: {"running": 0, "waiting": 0, "avg_wait": 0.0, "last_wait": 0.0}
+            for model in MODELS.values()
+        }
+        self.sd_jobs = 0
+
+    async def listen(self):
+        """Приём выданных мест и состояния очередей до получения None"""
+        loop = asyncio.get_running_loop()
+        while (message := await loop.run_in_executor(None, self.replies.get)) is not None:
+            if message[0] == "granted":
+                future = self.pending.get(message[1])
+                if future and not future.done():
+                    future.set_result(message[2])
+            else:
+                _, self.llm_stats, self.sd_jobs = message
+
+    def stop(self):
+        self.replies.put(None)
+
+    @asynccontextmanager
+    async def slot(self, resource, priority=PRIORITY_TEXT):
+        """Ожидание места в очереди модели или SD, возвращает keep_alive для запроса"""
+        request_id = next(self.counter)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.requests.put(("acquire", self.index, request_id, resource, priority))
+        try:
+            yield await future
+        finally:
+            # Освобождение места или отказ от ожидания
+            del self.pending[request_id]
+            self.requests.put(("release", self.index, request_id))
+
+    def stats(self):
+        return self.llm_stats
+
+async def serve_gateway(requests, replies):
+    """Общие очереди Ollama и SD для процессов-обработчиков (в основном процессе).
+    Место удерживается задачей до сообщения об освобождении; каждое изменение
+    рассылается обработчикам для сброса нагрузки и /queue"""
+    loop = asyncio.get_running_loop()
+    held = {}  # (процесс, номер запроса) -> задача, удерживающая место
+    broadcast_scheduled = False
+
+    def broadcast():
+        nonlocal broadcast_scheduled
+        broadcast_scheduled = False
+        snapshot = ("stats", llm_scheduler.stats(), sd_jobs)
+        for queue in replies:
+            queue.put(snapshot)
+
+    def schedule_broadcast():
+        # Одна рассылка на пачку изменений, после того как задачи встали в очереди
+        nonlocal broadcast_scheduled
+        if not broadcast_scheduled:
+            broadcast_scheduled = True
+            loop.call_soon(broadcast)
+
+    async def hold(worker, request_id, resource, priority):
+        global sd_jobs
+        try:
+            if resource == SD_RESOURCE:
+                sd_jobs += 1
+                try:
+                    async with sd_semaphore:
+                        replies[worker].put(("granted", request_id, None))
+                        schedule_broadcast()
+                        await asyncio.Future()
+                finally:
+                    sd_jobs -= 1
+            else:
+                async with llm_scheduler.slot(resource, priority) as keep_alive:
+                    replies[worker].put(("granted", request_id, keep_alive))
+                    schedule_broadcast()
+                    await asyncio.Future()
+        finally:
+            held.pop((worker, request_id), None)
+            schedule_broadcast()
+
+    try:
+        while (message := await loop.run_in_executor(None, requests.get)) is not None:
+            kind, worker, request_id, *args = message
+            if kind == "acquire":
+                held[(worker, request_id)] = asyncio.ensure_future(hold(worker, request_id, *args))
+            else:
+                # Задача могла ещё не начаться, поэтому убирается из held здесь же
+                task = held.pop((worker, request_id), None)
+                if task:
+                    task.cancel()
+            schedule_broadcast()
+    finally:
+        for task in held.values():
+            task.cancel()
+
+class RateLimiter:
+    """Token bucket на пару (пользователь, вид запроса).
+    Корзина пополняется со скоростью rate в минуту до burst токенов"""
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, limits):
+        self.limits = limits  # вид запроса -> (в минуту, burst)
+        self.buckets = {}  # (user_id, вид запроса) -> [токены, время обновления]
+
+    def _refill(self, bucket, rate, burst, now):
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate / 60)
+        bucket[1] = now
+
+    def acquire(self, user_id, capability, now=None):
+        """Списание токена. Возвращает 0, если запрос разрешён, иначе сколько секунд ждать"""
+        rate, burst = self.limits[capability]
+        if rate <= 0 or burst <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self._prune(now)
+        bucket = self.buckets.setdefault((user_id, capability), [burst, now])
+        self._refill(bucket, rate, burst, now)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) * 60 / rate
+
+    def _prune(self, now):
+        """Удаление полных корзин: они ничем не отличаются от новых"""
+        for key, bucket in list(self.buckets.items()):
+            rate, burst = self.limits[key[1]]
+            self._refill(bucket, rate, burst, now)
+            if bucket[0] >= burst:
+                del self.buckets[key]
+
+# Ограничение частоты запросов пользователей
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+def busy_retry_after(capability):
+    """Сброс нагрузки: 0, если запрос можно принять, иначе через сколько секунд повторить"""
+    if capability in ("text", "image"):
+        stats = llm_scheduler.stats().values()
+        if LLM_QUEUE_LIMIT and sum(item["waiting"] for item in stats) >= LLM_QUEUE_LIMIT:
+            # Недавнее время ожидания в очереди - оценка, когда она рассосётся
+            return max([BUSY_RETRY_AFTER] + [item["last_wait"] for item in stats])
+    elif capability == "voice":
+        if voice_queue.full():
+            return BUSY_RETRY_AFTER
+    elif capability == "draw":
+        if sd_queue_length() >= SD_QUEUE_SIZE:
+            return BUSY_RETRY_AFTER
+    return 0
+
+async def admit(message, user_id, capability):
+    """Проверка нагрузки и лимита пользователя перед тяжёлым запросом.
+    При отказе отвечает пользователю и возвращает False"""
+    retry_after = busy_retry_after(capability)
+    if retry_after:
+        metrics.inc("bot_rejected_total", capability=capability, reason="busy")
+        await message.reply_text(f"⏳ Бот перегружен, повторите через {math.ceil(retry_after)} с")
+        return False
+    retry_after = rate_limiter.acquire(user_id, capability)
+    if retry_after:
+        metrics.inc("bot_rejected_total", capability=capability, reason="rate")
+        await message.reply_text(f"⏳ Слишком много запросов, повторите через {math.ceil(retry_after)} с")
+        return False
+    return True
+
+@metrics.gauge
+def queue_gauges():
+    """Глубина очередей и статистика кэшей для /metrics"""
+    values = []
+    for model, stats in llm_scheduler.stats().items():
+        values.append(("llm_requests_running", {"model": model}, stats["running"]))
+        values.append(("llm_requests_waiting", {"model": model}, stats["waiting"]))
+    values.append(("voice_queue_waiting", {}, voice_queue.size))
+    values.append(("voice_batches_running", {}, voice_queue.active))
+    values.append(("sd_jobs", {}, sd_queue_length()))
+    for cache in caches:
+        values.append(("cache_hits", {"cache": cache.name}, cache.hits))
+        values.append(("cache_misses", {"cache": cache.name}, cache.misses))
+    return values
+
+def pick_photo(photos):
+    """Наименьший из размеров фото Telegram, не меньше VISION_MAX_SIDE"""
+    if VISION_MAX_SIDE <= 0:
+        return photos[-1]
+    for photo in sorted(photos, key=lambda size: max(size.width, size.height)):
+        if max(photo.width, photo.height) >= VISION_MAX_SIDE:
+            return photo
+    return photos[-1]
+
+def resize_image(image_bytes, max_side):
+    """Уменьшение картинки по длинной стороне (выполняется в отдельном потоке)"""
+    image = Image.open(io.BytesIO(image_bytes))
+    if max(image.size) <= max_side:
+        return image_bytes
+    image.thumbnail((max_side, max_side))
+    with io.BytesIO() as img_buffer:
+        image.convert("RGB").save(img_buffer, format="JPEG", quality=90)
+        return img_buffer.getvalue()
+
+async def download_vision_image(bot, photo):
+    """Скачивание фото для мультимодальной модели в base64 с уменьшением при необходимости"""
+    file = await bot.get_file(photo.file_id)
+    image_bytes = bytes(await file.download_as_bytearray())
+    if VISION_RESIZE and VISION_MAX_SIDE > 0 and max(photo.width, photo.height) > VISION_MAX_SIDE:
+        image_bytes = await asyncio.to_thread(resize_image, image_bytes, VISION_MAX_SIDE)
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+async def reply_long(message, text):
+    """Отправка текста, разбитого на части по лимиту Telegram"""
+    start = 0
+    while len(text) - start > TELEGRAM_MESSAGE_LIMIT:
+        cut = split_point(text, start)
+        await message.reply_text(text[start:cut])
+        start = cut
+    await message.reply_text(text[start:])
+
+def record_generation(model, response):
+    """Метрики скорости генерации из итогового ответа Ollama"""
+    if not response or not response.get("eval_count"):
+        return
+    prompt_tokens = response.get("prompt_eval_count") or 0
+    prompt_seconds = (response.get("prompt_eval_duration") or 0) / 1e9
+    metrics.inc("llm_eval_tokens_total", response["eval_count"], model=model)
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens, model=model)
+    # Мало токенов промта при длинной истории - Ollama взяла начало из кэша
+    metrics.observe("llm_prompt_eval_seconds", prompt_seconds, model=model)
+    logging.info(
+        f"{model}: обработано токенов промта {prompt_tokens} за {prompt_seconds:.2f} с, "
+        f"сгенерировано {response['eval_count']}"
+    )
+    if response.get("eval_duration"):
+        metrics.observe(
+            "llm_tokens_per_second",
+            response["eval_count"] / (response["eval_duration"] / 1e9),
+            model=model,
+        )
+
+class GenerationCancelled(Exception):
+    """Генерация остановлена пользователем: /stop, /clear или новым сообщением"""
+
+def cancel_generation(user_id):
+    """Остановка текущей генерации пользователя. Возвращает True, если было что останавливать"""
+    task = generations.get(user_id)
+    if task is None or task.done():
+        return False
+    task.cancel()
+    return True
+
+async def ask_model(message, prefix="", priority=PRIORITY_TEXT, timeout=None, **chat_kwargs):
+    """Запрос к Ollama через планировщик с отправкой ответа пользователю.
+    Генерация идёт отдельной задачей, которую можно остановить через cancel_generation.
+    Возвращает текст ответа"""
+    user_id = str(message.from_user.id)
+    task = asyncio.ensure_future(generate_reply(message, prefix, priority, timeout, chat_kwargs))
+    generations[user_id] = task
+    try:
+        async with outside_update_slot():
+            return await task
+    except asyncio.CancelledError:
+        # Отменён сам обработчик (остановка бота) - отмена идёт дальше
+        if asyncio.current_task().cancelling():
+            raise
+        metrics.inc("llm_cancelled_total", model=chat_kwargs["model"])
+        raise GenerationCancelled from None
+    finally:
+        if generations.get(user_id) is task:
+            del generations[user_id]
+
+async def generate_reply(message, prefix, priority, timeout, chat_kwargs):
+    """Генерация ответа с ограничением по времени после получения места в очереди"""
+    model = chat_kwargs["model"]
+    try:
+        async with llm_scheduler.slot(model, priority) as keep_alive:
+            chat_kwargs["keep_alive"] = keep_alive
+            async with asyncio.timeout(timeout or None):
+                with metrics.timer("llm_generation_seconds", model=model):
+                    if STREAM_REPLIES:
+                        stream = await ollama_client.chat(stream=True, **chat_kwargs)
+                        content, response = await stream_reply(message, stream, prefix)
+                    else:
+                        response = await ollama_client.chat(**chat_kwargs)
+                        content = response["message"]["content"]
+                        with metrics.timer("bot_stage_seconds", stage="reply"):
+                            await reply_long(message, prefix + content)
+    except TimeoutError:
+        metrics.inc("bot_errors_total", stage="ollama_timeout")
+        raise
+    except Exception:
+        metrics.inc("bot_errors_total", stage="ollama")
+        raise
+    record_generation(model, response)
+    return content
+
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
-    user_id = str(update.effective_user.id)
-    
-    # Инициализация данных пользователя
-    user = ensure_user_data(user_id)
+    user = context.user
     
     if user["authenticated"]:
         name = user.get("name", "пользователь")
@@ -120,15 +1831,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     else:
         await update.message.reply_text("🔐 Введите пароль для доступа:")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def switch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик смены модели /switch [1/2/3]"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     if not context.args:
         current_model = user["model"]
         model_name = MODELS[current_model]
@@ -138,21 +1845,17 @@ async def switch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     model_choice = context.args[0]
     if model_choice in MODELS:
         user["model"] = model_choice
-        save_user_data(user_data)
+        save_user_data(user_id)
         model_name = MODELS[model_choice]
         await update.message.reply_text(f"✅ Модель изменена на {model_name}")
     else:
         await update.message.reply_text("⚠️ Доступные модели: 1, 2 или 3")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def set_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Изменение системного промта /system_prompt [текст]"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     if not context.args:
         current_prompt = user["system_prompt"]
         await update.message.reply_text(
@@ -162,8 +1865,12 @@ async def set_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
         
     new_prompt = " ".join(context.args)
+    # Тот же промт не трогаем, чтобы не сбрасывать кэш начала диалога в Ollama
+    if new_prompt == user["system_prompt"]:
+        await update.message.reply_text("✅ Системный промт не изменился")
+        return
     user["system_prompt"] = new_prompt
-    save_user_data(user_data)
+    save_user_data(user_id)
     
     # Обновляем системный промт в контекстной памяти
     if user_id in context_memory and len(context_memory[user_id]) > 0:
@@ -171,19 +1878,16 @@ async def set_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
         for i, msg in enumerate(context_memory[user_id]):
             if msg["role"] == "system":
                 context_memory[user_id][i]["content"] = new_prompt
+                context_memory[user_id][i].pop("tokens", None)
                 break
     
     await update.message.reply_text(f"✅ Системный промт обновлен:\n{new_prompt}")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def set_thinking_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Настройка режима мышления через /think [0/1]"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     if not context.args:
         mode = (
             "🧠 Мышление: ВКЛ"
@@ -196,26 +1900,22 @@ async def set_thinking_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
     mode_arg = context.args[0]
     if mode_arg == "1":
         user["think_mode"] = True
-        save_user_data(user_data)
+        save_user_data(user_id)
         await update.message.reply_text("🧠 Режим мышления: ВКЛ")
     elif mode_arg == "0":
         user["think_mode"] = False
-        save_user_data(user_data)
+        save_user_data(user_id)
         await update.message.reply_text("🧠 Режим мышления: ВЫКЛ")
     else:
         await update.message.reply_text(
             "⚠️ Неверный аргумент. Используйте:\n/think 0 - выключить\n/think 1 - включить"
         )
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def set_temperature(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Настройка температуры генерации"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     if not context.args:
         temp = user["temperature"]
         await update.message.reply_text(f"🌡️ Текущая температура: {temp}")
@@ -225,22 +1925,18 @@ async def set_temperature(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         temp = float(context.args[0])
         if 0 <= temp <= 1:
             user["temperature"] = temp
-            save_user_data(user_data)
+            save_user_data(user_id)
             await update.message.reply_text(f"🌡️ Температура установлена: {temp}")
         else:
             await update.message.reply_text("⚠️ Температура должна быть от 0 до 1")
     except ValueError:
         await update.message.reply_text("⚠️ Укажите числовое значение")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def set_context_size(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Настройка размера контекстной памяти /cs [2-50]"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     if not context.args:
         size = user["context_size"]
         await update.message.reply_text(f"💾 Размер контекста: {size}")
@@ -250,7 +1946,7 @@ async def set_context_size(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         new_size = int(context.args[0])
         if 2 <= new_size <= 50:
             user["context_size"] = new_size
-            save_user_data(user_data)
+            save_user_data(user_id)
             await update.message.reply_text(
                 f"✅ Размер контекста изменен на {new_size}"
             )
@@ -259,12 +1955,10 @@ async def set_context_size(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     except ValueError:
         await update.message.reply_text("⚠️ Укажите числовое значение")
 
+@track_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка текстовых сообщений"""
-    user_id = str(update.effective_user.id)
-    
-    # Инициализация данных пользователя
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
     # Проверка аутентификации
     if not user["authenticated"]:
@@ -272,8 +1966,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if message_text == PASSWORD:
             user["authenticated"] = True
             user["name"] = None  # Флаг для запроса имени
-            context_memory[user_id] = [{"role": "system", "content": user["system_prompt"]}]
-            save_user_data(user_data)
+            context_memory[user_id] = new_history(user["system_prompt"])
+            save_user_data(user_id)
             await update.message.reply_text("✅ Пароль принят!\n📝 Введите ваше имя:")
         else:
             await update.message.reply_text("❌ Неверный пароль")
@@ -282,112 +1976,183 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Обработка имени
     if user.get("name") is None:
         user["name"] = update.message.text
-        save_user_data(user_data)
+        save_user_data(user_id)
         await update.message.reply_text(
             f"👋 Рад знакомству, {user['name']}! Теперь вы можете задавать вопросы или просто общаться со мной!"
         )
         return
         
     # Обработка сообщения
-    message_text = context.user_data.get("voice_text") or update.message.text
+    if not await admit(update.message, user_id, "text"):
+        return
+    await answer_text(update, context, update.message.text)
+
+async def answer_text(update, context, message_text):
+    """Ответ модели на текст пользователя (сообщение или расшифровку голосового)"""
+    user_id, user = context.user_id, context.user
     
     # Подготовка контекста
     if user_id not in context_memory:
-        context_memory[user_id] = [{"role": "system", "content": user["system_prompt"]}]
+        context_memory[user_id] = new_history(user["system_prompt"])
+        
+    # Ответ на первый вопрос диалога с низкой температурой можно взять из кэша по смыслу
+    semantic = (
+        semantic_cache is not None
+        and len(context_memory[user_id]) == 1
+        and user["temperature"] <= SEMANTIC_CACHE_MAX_TEMPERATURE
+    )
+    if semantic:
+        scope = SemanticCache.scope_id(MODELS[user["model"]], user["system_prompt"], user["think_mode"])
+        answer, question_vector = await semantic_cache.get(scope, message_text)
+        if answer is not None:
+            await reply_long(update.message, answer)
+            context_memory[user_id].append({"role": "user", "content": message_text})
+            context_memory[user_id].append({"role": "assistant", "content": answer})
+            return
         
-    # Добавление метки мышления для Qwen3
-    if user["model"] == "1":  # Qwen3
-        if user["think_mode"]:
-            message_text = f"[THINK] {message_text}"
-        else:
-            message_text = f"[NO_THINK] {message_text}"
-            
     # Обновление контекста
     context_memory[user_id].append({"role": "user", "content": message_text})
     
-    # Ограничение длины контекста через настройку пользователя
-    max_context = user.get("context_size", 21)
-    while len(context_memory[user_id]) > max_context:
-        context_memory[user_id].pop(1)
+    # Ограничение контекста по числу сообщений и бюджету токенов модели
+    if trim_history(
+        context_memory[user_id],
+        user.get("context_size", 21),
+        token_budget(user["model"]),
+    ):
+        await update.message.reply_text(
+            "✂️ Сообщение не помещается в контекст модели, середина текста пропущена"
+        )
         
     try:
-        # Получение ответа от модели
-        response = ollama.chat(
+        # Получение ответа от модели с отправкой пользователю
+        answer = await ask_model(
+            update.message,
             model=MODELS[user["model"]],
             messages=context_memory[user_id],
-            options={"temperature": user["temperature"]},
+            options={
+                "temperature": user["temperature"],
+                "num_ctx": MODEL_NUM_CTX[user["model"]],
+            },
+            # Режим мышления Qwen3 передаётся параметром, а не меткой в тексте,
+            # поэтому сохранённая история не меняется при переключении режима
+            think=user["think_mode"] if user["model"] == "1" else None,
+            timeout=MODEL_TIMEOUT[user["model"]],
         )
         
         # Добавление ответа в контекст
-        context_memory[user_id].append(
-            {"role": "assistant", "content": response["message"]["content"]}
-        )
-        
-        # Отправка ответа пользователю
-        await update.message.reply_text(response["message"]["content"])
+        context_memory[user_id].append({"role": "assistant", "content": answer})
+        if semantic:
+            await semantic_cache.put(scope, message_text, question_vector, answer)
+    except GenerationCancelled:
+        logging.info(f"Генерация для {user_id} остановлена")
+    except TimeoutError:
+        await update.message.reply_text("⏳ Модель отвечала слишком долго, генерация остановлена")
     except Exception as e:
         logging.error(f"Ошибка Ollama: {e}")
         await update.message.reply_text("⚠️ Ошибка генерации ответа")
 
+def voice_progress(tasks):
+    """Текст статуса длинного голосового: готовые куски по порядку, «…» на месте остальных"""
+    ready = sum(task.done() for task in tasks)
+    header = f"🎙️ Распознано {ready} из {len(tasks)}:\n"
+    text = " ".join(task.result().strip() if task.done() else "…" for task in tasks)
+    # Показываем конец текста, если он не помещается в сообщение
+    return header + text[-(TELEGRAM_MESSAGE_LIMIT - len(header)):]
+
+async def transcribe_long_voice(user_id, voice_bytes, status):
+    """Распознавание длинного голосового: разрезание по паузам, параллельное
+    распознавание кусков через общую очередь и показ текста по мере готовности"""
+    # Разрезание идёт вне пула Whisper, чтобы не занимать воркер в обход учёта очереди
+    with metrics.timer("bot_stage_seconds", stage="voice_split"):
+        chunks = await asyncio.to_thread(split_voice, voice_bytes)
+    if not chunks:
+        return ""
+    # Куски занимают места в очереди; в пустую очередь сообщение принимается целиком
+    if voice_queue.size and voice_queue.size + len(chunks) > voice_queue.max_size:
+        raise asyncio.QueueFull
+    tasks = [
+        asyncio.ensure_future(voice_queue.submit(user_id, chunk, reserved=True))
+        for chunk in chunks
+    ]
+    last_edit = time.monotonic()
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()  # Ошибка куска прерывает всё распознавание
+            if pending and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                await edit_message(status, voice_progress(tasks))
+                last_edit = time.monotonic()
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return " ".join(task.result().strip() for task in tasks)
+
+@track_handler(auth="Введите пароль для доступа!")
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка голосовых сообщений"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id = context.user_id
     
-    if not user["authenticated"]:
-        await update.message.reply_text("Введите пароль для доступа!")
+    if not await admit(update.message, user_id, "voice"):
         return
         
     try:
-        # Скачивание и конвертация аудио
+        # Скачивание аудио
         voice = update.message.voice
         file = await context.bot.get_file(voice.file_id)
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_ogg:
-            await file.download_to_drive(temp_ogg.name)
-            audio = AudioSegment.from_ogg(temp_ogg.name)
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav:
-                audio.export(
-                    temp_wav.name, format="wav", parameters=["-ac", "1", "-ar", "16000"]
-                )
-                # Распознавание речи
-                segments, _ = whisper_model.transcribe(
-                    temp_wav.name, language="ru", beam_size=5, vad_filter=True
-                )
-                text = " ".join([segment.text for segment in segments])
+        with metrics.timer("bot_stage_seconds", stage="voice_download"):
+            voice_bytes = bytes(await file.download_as_bytearray())
+            
+        # Постановка в очередь распознавания с уведомлением о позиции
+        position = voice_queue.position(user_id)
+        if position:
+            status = await update.message.reply_text(f"🎙️ В очереди: {position}")
+        else:
+            status = await update.message.reply_text("🎙️ Распознаю...")
+            
+        async def on_start():
+            if position:
+                await edit_message(status, "🎙️ Распознаю...")
                 
-        # Удаление временных файлов
-        os.unlink(temp_ogg.name)
-        os.unlink(temp_wav.name)
+        async with outside_update_slot():
+            with metrics.timer("bot_stage_seconds", stage="voice_transcribe"):
+                if voice.duration and voice.duration > LONG_VOICE_SECONDS:
+                    text = await transcribe_long_voice(user_id, voice_bytes, status)
+                else:
+                    text = await voice_queue.submit(user_id, voice_bytes, on_start=on_start)
         
         if text.strip():
             # Отправка транскрипта и обработка текста
-            await update.message.reply_text(f"📝 Транскрипт:\n{text}")
-            context.user_data["voice_text"] = text
-            await handle_message(update, context)
-            del context.user_data["voice_text"]
+            transcript = f"📝 Транскрипт:\n{text}"
+            if len(transcript) <= TELEGRAM_MESSAGE_LIMIT:
+                await edit_message(status, transcript)
+            else:
+                await status.delete()
+                await reply_long(update.message, transcript)
+            # Расшифровка уже прошла проверку лимитов как голосовое
+            await answer_text(update, context, text)
         else:
-            await update.message.reply_text("Не удалось распознать речь.")
+            await edit_message(status, "Не удалось распознать речь.")
+    except asyncio.QueueFull:
+        await update.message.reply_text("⏳ Слишком много голосовых сообщений, попробуйте позже")
     except Exception as e:
+        metrics.inc("bot_errors_total", stage="voice")
         logging.error(f"Ошибка обработки голоса: {e}")
         await update.message.reply_text(f"Произошла ошибка: {str(e)[:100]}")
 
+@track_handler(auth="Введите пароль для доступа!")
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка изображений с использованием qwen3-vl:8b или текущей модели"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("Введите пароль для доступа!")
+    if not await admit(update.message, user_id, "image"):
         return
         
     try:
-        # Получение фото
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-        
-        # Конвертация в base64
-        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+        # Наименьший подходящий размер фото
+        photo = pick_photo(update.message.photo)
         
         # Получение пользовательского промта (если есть текст вместе с фото)
         user_prompt = update.message.caption or "Что изображено на этой картинке? Опиши подробно."
@@ -402,51 +2167,70 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         
         # Подготовка контекста
         if user_id not in context_memory:
-            context_memory[user_id] = [{"role": "system", "content": user["system_prompt"]}]
-        
-        # Формирование запроса с изображением (используем chat API с images)
-        messages = context_memory[user_id].copy()
-        messages.append({
-            "role": "user",
-            "content": user_prompt,
-            "images": [image_base64]
-        })
-        
-        # Получение ответа от Ollama
-        response = ollama.chat(
-            model=model_name,
-            messages=messages,
-            options={"temperature": user["temperature"]},
+            context_memory[user_id] = new_history(user["system_prompt"])
+        
+        # Повторная картинка с тем же промтом берётся из кэша без скачивания
+        cache_key = ResponseCache.make_key(
+            photo.file_unique_id,
+            user_prompt,
+            model_name,
+            user["system_prompt"],
+            round(user["temperature"], 1),
         )
+        answer = await answer_cache.get(cache_key)
+        if answer is not None:
+            await reply_long(update.message, f"🖼️ Описание изображения:\n{answer}")
+        else:
+            # Получение фото в base64
+            with metrics.timer("bot_stage_seconds", stage="image_download"):
+                image_base64 = await download_vision_image(context.bot, photo)
+            
+            # Формирование запроса с изображением (используем chat API с images)
+            messages = context_memory[user_id].copy()
+            messages.append({
+                "role": "user",
+                "content": user_prompt,
+                "images": [image_base64]
+            })
+            
+            # Получение ответа от Ollama с отправкой пользователю
+            answer = await ask_model(
+                update.message,
+                prefix="🖼️ Описание изображения:\n",
+                priority=PRIORITY_IMAGE,
+                model=model_name,
+                messages=messages,
+                options={"temperature": user["temperature"], "num_ctx": MODEL_NUM_CTX["3"]},
+                timeout=MODEL_TIMEOUT["3"],
+            )
+            await answer_cache.put(cache_key, answer)
         
         # Добавляем ответ в контекстную память (без изображения)
         context_memory[user_id].append({"role": "user", "content": user_prompt})
-        context_memory[user_id].append(
-            {"role": "assistant", "content": response["message"]["content"]}
-        )
+        context_memory[user_id].append({"role": "assistant", "content": answer})
         
-        # Ограничение длины контекста
-        max_context = user.get("context_size", 21)
-        while len(context_memory[user_id]) > max_context:
-            context_memory[user_id].pop(1)
-        
-        await update.message.reply_text(
-            f"🖼️ Описание изображения:\n{response['message']['content']}"
+        # Ограничение контекста по числу сообщений и бюджету токенов
+        trim_history(
+            context_memory[user_id],
+            user.get("context_size", 21),
+            token_budget("3"),
         )
+    except GenerationCancelled:
+        logging.info(f"Описание изображения для {user_id} остановлено")
+    except TimeoutError:
+        await update.message.reply_text("⏳ Модель отвечала слишком долго, генерация остановлена")
     except Exception as e:
+        metrics.inc("bot_errors_total", stage="image")
         logging.error(f"Ошибка обработки изображения: {e}")
         await update.message.reply_text(f"Не удалось обработать изображение: {str(e)[:100]}")
 
+@track_handler(auth="🔒 Требуется авторизация через /start")
 async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Генерация изображений через Stable Diffusion"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
-    
+    global sd_jobs
+    user_id = context.user_id
     logging.info(f"Draw command from {user_id}")
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Требуется авторизация через /start")
-        return
-        
+    
     if not context.args:
         await update.message.reply_text("📝 Формат: /d [описание изображения]")
         return
@@ -460,53 +2244,165 @@ async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "sampler_name": "Euler a",
         "width": 1024,
         "height": 1024,
+        "seed": SD_SEED,
         "override_settings": {
             "sd_model_checkpoint": "sdXL_v10VAEFix.safetensors [e6bb9ea85b]"
         },
     }
     
+    if not await admit(update.message, user_id, "draw"):
+        return
+        
+    # Генерация идёт в фоне, обработчик сразу освобождается
+    if queued := sd_queue_length():
+        status = await update.message.reply_text(f"🎨 В очереди: {queued}")
+    else:
+        status = await update.message.reply_text("🎨 Генерация...")
+    sd_jobs += 1
+    context.application.create_task(
+        draw_job(update.message, status, prompt, payload), update=update
+    )
+
+def sd_queue_length():
+    """Генераций SD в очереди и в работе (при нескольких процессах - во всех)"""
+    return gateway.sd_jobs if gateway else sd_jobs
+
+@asynccontextmanager
+async def sd_slot():
+    """Место для генерации в Stable Diffusion, общее для всех процессов"""
+    if gateway:
+        async with gateway.slot(SD_RESOURCE):
+            yield
+    else:
+        async with sd_semaphore:
+            yield
+
+async def sd_models_available():
+    """Проверка доступности моделей SD с кэшированием на SD_MODEL_CHECK_TTL"""
+    global sd_models_checked_at
+    now = time.monotonic()
+    if sd_models_checked_at is not None and now - sd_models_checked_at < SD_MODEL_CHECK_TTL:
+        return True
+    async with sd_session.get("/sdapi/v1/sd-models") as model_check:
+        if model_check.status != 200:
+            return False
+    sd_models_checked_at = now
+    return True
+
+async def report_sd_progress(status):
+    """Периодическое обновление сообщения о прогрессе генерации"""
+    while True:
+        await asyncio.sleep(SD_PROGRESS_INTERVAL)
+        try:
+            async with sd_session.get(
+                "/sdapi/v1/progress", params={"skip_current_image": "true"}
+            ) as response:
+                progress = await response.json()
+            percent = int(progress.get("progress", 0) * 100)
+            eta = progress.get("eta_relative", 0)
+            await edit_message(status, f"🎨 Генерация: {percent}% (осталось ~{eta:.0f} с)")
+        except Exception as e:
+            logging.warning(f"Не удалось получить прогресс SD: {e}")
+
+def encode_image(image_data, image_format, **params):
+    """Перекодирование картинки (выполняется в отдельном потоке)"""
+    with io.BytesIO() as img_buffer:
+        image = Image.open(io.BytesIO(image_data))
+        if image_format == "JPEG":
+            image = image.convert("RGB")
+        image.save(img_buffer, format=image_format, **params)
+        return img_buffer.getvalue()
+
+async def prepare_image_upload(image_data):
+    """Байты картинки для отправки в Telegram и имя файла.
+    PNG и JPEG уходят без перекодирования, остальное кодируется в пуле потоков"""
+    if SD_UPLOAD_FORMAT == "jpeg" and not image_data.startswith(b"\xff\xd8"):
+        jpeg = await asyncio.to_thread(encode_image, image_data, "JPEG", quality=SD_JPEG_QUALITY)
+        return jpeg, "art.jpg"
+    if image_data.startswith(b"\x89PNG"):
+        return image_data, "art.png"
+    if image_data.startswith(b"\xff\xd8"):
+        return image_data, "art.jpg"
+    return await asyncio.to_thread(encode_image, image_data, "PNG"), "art.png"
+
+async def send_cached_image(message, status, prompt, cache_key):
+    """Отправка картинки из кэша. Возвращает True, если она там была"""
+    image_data = await image_cache.get(cache_key)
+    if image_data is None:
+        return False
+    filename = "art.jpg" if image_data.startswith(b"\xff\xd8") else "art.png"
+    await message.reply_photo(
+        photo=InputFile(image_data, filename=filename),
+        caption=f"🎨 {prompt[:100]}...",
+    )
+    await status.delete()
+    return True
+
+async def draw_job(message, status, prompt, payload):
+    """Фоновая генерация изображения с отчётом о прогрессе"""
+    global sd_jobs
     try:
-        async with aiohttp.ClientSession() as session:
+        # С фиксированным seed результат повторяется, его можно взять из кэша
+        cache_key = ResponseCache.make_key(payload) if payload["seed"] >= 0 else None
+        if cache_key and await send_cached_image(message, status, prompt, cache_key):
+            return
+            
+        queued = time.monotonic()
+        async with sd_slot():
+            metrics.observe("bot_stage_seconds", time.monotonic() - queued, stage="sd_queue")
+            # Такая же генерация могла завершиться, пока задание ждало очереди
+            if cache_key and await send_cached_image(message, status, prompt, cache_key):
+                return
+            await edit_message(status, "🎨 Генерация...")
             # Проверка доступности моделей
-            async with session.get(
-                "http://localhost:7860/sdapi/v1/sd-models"
-            ) as model_check:
-                if model_check.status != 200:
-                    await update.message.reply_text("⚠️ Модель SD не загружена")
-                    return
-                    
+            if not await sd_models_available():
+                await edit_message(status, "⚠️ Модель SD не загружена")
+                return
+                
             # Основной запрос
-            async with session.post(
-                "http://localhost:7860/sdapi/v1/txt2img", json=payload, timeout=300
-            ) as response:
-                logging.info(f"API Response: {response.status}")
-                if response.status != 200:
-                    error = await response.text()
-                    logging.error(f"API Error: {error}")
-                    await update.message.reply_text(f"❌ Ошибка API: {response.status}")
-                    return
-                    
-                data = await response.json()
-                if not data.get("images"):
-                    await update.message.reply_text("🖼️ Пустой ответ от генератора")
-                    return
-                    
-                image_data = base64.b64decode(data["images"][0])
-                with io.BytesIO() as img_buffer:
-                    Image.open(io.BytesIO(image_data)).save(img_buffer, format="PNG")
-                    img_buffer.seek(0)
-                    await update.message.reply_photo(
-                        photo=InputFile(img_buffer, filename="art.png"),
-                        caption=f"🎨 {prompt[:100]}...",
-                    )
-                    logging.info("Изображение успешно отправлено")
+            progress_task = asyncio.ensure_future(report_sd_progress(status))
+            try:
+                with metrics.timer("bot_stage_seconds", stage="sd_generate"):
+                    async with sd_session.post(
+                        "/sdapi/v1/txt2img", json=payload, timeout=aiohttp.ClientTimeout(total=300)
+                    ) as response:
+                        logging.info(f"API Response: {response.status}")
+                        if response.status != 200:
+                            error = await response.text()
+                            logging.error(f"API Error: {error}")
+                            metrics.inc("bot_errors_total", stage="sd")
+                            await edit_message(status, f"❌ Ошибка API: {response.status}")
+                            return
+                        data = await response.json()
+            finally:
+                progress_task.cancel()
+                
+        if not data.get("images"):
+            await edit_message(status, "🖼️ Пустой ответ от генератора")
+            return
+            
+        image_data, filename = await prepare_image_upload(base64.b64decode(data["images"][0]))
+        if cache_key:
+            await image_cache.put(cache_key, image_data)
+        with metrics.timer("bot_stage_seconds", stage="sd_upload"):
+            await message.reply_photo(
+                photo=InputFile(image_data, filename=filename),
+                caption=f"🎨 {prompt[:100]}...",
+            )
+        await status.delete()
+        logging.info("Изображение успешно отправлено")
     except asyncio.TimeoutError:
+        metrics.inc("bot_errors_total", stage="sd_timeout")
         logging.warning("Таймаут генерации")
-        await update.message.reply_text("⏳ Слишком долгая генерация, попробуйте позже")
+        await edit_message(status, "⏳ Слишком долгая генерация, попробуйте позже")
     except Exception as e:
+        metrics.inc("bot_errors_total", stage="sd")
         logging.error(f"Critical Draw Error: {str(e)}", exc_info=True)
-        await update.message.reply_text("🔥 Ошибка в процессе генерации")
+        await edit_message(status, "🔥 Ошибка в процессе генерации")
+    finally:
+        sd_jobs -= 1
 
+@track_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик помощи /help"""
     help_text = (
@@ -519,8 +2415,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/cs [2-50] - Установить размер контекстной памяти\n"
         "/clear - Очистить все данные и выйти\n"
         "/clearc - Очистить контекст диалога\n"
+        "/stop - Остановить текущую генерацию ответа\n"
         "/info - Показать информацию о себе\n"
         "/changename [новое_имя] - Изменить ваше отображаемое имя\n"
+        "/queue - Показать очередь запросов к моделям\n"
         "/help - Показать справку\n"
         "/d [описание] - Сгенерировать изображение\n\n"
         "Также вы можете:\n"
@@ -530,14 +2428,24 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
     await update.message.reply_text(help_text)
 
+@track_handler
+async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Остановка текущей генерации /stop (выполняется вне очереди пользователя)"""
+    user_id = context.user_id
+    if cancel_generation(user_id):
+        await update.message.reply_text("⏹ Генерация остановлена")
+    else:
+        await update.message.reply_text("Сейчас ничего не генерируется")
+
+@track_handler
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /clear - очищает данные пользователя и выходит"""
-    user_id = str(update.effective_user.id)
+    user_id = context.user_id
     
     # Удаление данных пользователя
     if user_id in user_data:
         del user_data[user_id]
-        save_user_data(user_data)
+        save_user_data(user_id)
         
     # Очистка контекста диалога
     if user_id in context_memory:
@@ -547,30 +2455,22 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "✅ Все данные очищены. Для продолжения введите /start."
     )
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def clear_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Очистка контекста диалога /clearc"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     if user_id in context_memory:
         # Оставляем только системный промт
-        context_memory[user_id] = [{"role": "system", "content": user["system_prompt"]}]
+        context_memory[user_id] = new_history(user["system_prompt"])
         
     await update.message.reply_text("🧹 Контекст очищен.")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать информацию о пользователе /info"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user = context.user
     
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     model_name = MODELS.get(user["model"], "Неизвестная модель")
     think_status = "ВКЛ" if user["think_mode"] else "ВЫКЛ"
     system_prompt_preview = user["system_prompt"][:50] + "..." if len(user["system_prompt"]) > 50 else user["system_prompt"]
@@ -585,16 +2485,11 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
     await update.message.reply_text(info_text)
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def change_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /changename [новое_имя]"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
+    user_id, user = context.user_id, context.user
     
-    # Проверка авторизации
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
-        
     # Проверка наличия аргумента
     if not context.args:
         await update.message.reply_text("📝 Формат: /changename [ваше_новое_имя]")
@@ -602,38 +2497,43 @@ async def change_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         
     new_name = " ".join(context.args)
     user["name"] = new_name
-    save_user_data(user_data)
+    save_user_data(user_id)
     await update.message.reply_text(f"✅ Имя изменено на: {new_name}")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def analyze_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Анализ изображения с пользовательским промтом /analyze [промт]"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
-    
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
+    user_id, user = context.user_id, context.user
     
     # Проверяем, есть ли изображение в сообщении
     if not update.message.photo:
         await update.message.reply_text("📷 Пожалуйста, отправьте изображение вместе с командой /analyze")
         return
     
+    if not await admit(update.message, user_id, "image"):
+        return
+    
     # Получаем промт из аргументов
     user_prompt = " ".join(context.args) if context.args else "Опиши это изображение подробно"
     
     try:
-        # Получение фото
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-        
-        # Конвертация в base64
-        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+        # Наименьший подходящий размер фото
+        photo = pick_photo(update.message.photo)
         
         # Используем qwen3-vl для анализа
         model_name = MODELS["3"]
         
+        # Повторная картинка с тем же промтом берётся из кэша без скачивания
+        cache_key = ResponseCache.make_key(photo.file_unique_id, user_prompt, model_name, "analyze")
+        answer = await answer_cache.get(cache_key)
+        if answer is not None:
+            await reply_long(update.message, f"🔍 Анализ изображения:\n{answer}")
+            return
+        
+        # Получение фото в base64
+        with metrics.timer("bot_stage_seconds", stage="image_download"):
+            image_base64 = await download_vision_image(context.bot, photo)
+        
         # Формирование запроса с изображением
         messages = [
             {"role": "system", "content": "Ты - помощник, который анализирует и описывает изображения."},
@@ -644,27 +2544,30 @@ async def analyze_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             }
         ]
         
-        # Получение ответа от Ollama
-        response = ollama.chat(
+        # Получение ответа от Ollama с отправкой пользователю
+        answer = await ask_model(
+            update.message,
+            prefix="🔍 Анализ изображения:\n",
+            priority=PRIORITY_IMAGE,
             model=model_name,
             messages=messages,
+            options={"num_ctx": MODEL_NUM_CTX["3"]},
+            timeout=MODEL_TIMEOUT["3"],
         )
-        
-        await update.message.reply_text(
-            f"🔍 Анализ изображения:\n{response['message']['content']}"
-        )
+        await answer_cache.put(cache_key, answer)
+    except GenerationCancelled:
+        logging.info(f"Анализ изображения для {user_id} остановлен")
+    except TimeoutError:
+        await update.message.reply_text("⏳ Модель отвечала слишком долго, генерация остановлена")
     except Exception as e:
+        metrics.inc("bot_errors_total", stage="image")
         logging.error(f"Ошибка анализа изображения: {e}")
         await update.message.reply_text(f"Не удалось проанализировать изображение: {str(e)[:100]}")
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
 async def list_models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать список доступных моделей /models"""
-    user_id = str(update.effective_user.id)
-    user = ensure_user_data(user_id)
-    
-    if not user["authenticated"]:
-        await update.message.reply_text("🔒 Сначала авторизуйтесь")
-        return
+    user = context.user
     
     current_model = MODELS[user["model"]]
     
@@ -676,6 +2579,20 @@ async def list_models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     models_text += f"\nТекущая модель: {current_model}"
     await update.message.reply_text(models_text)
 
+@track_handler(auth="🔒 Сначала авторизуйтесь")
+async def queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Состояние очереди запросов к моделям /queue"""
+    status_text = "📊 Очередь запросов:\n"
+    for model, stats in llm_scheduler.stats().items():
+        status_text += (
+            f"{model}: выполняется {stats['running']}, ждут {stats['waiting']}, "
+            f"среднее ожидание {stats['avg_wait']:.1f} с\n"
+        )
+    status_text += f"🎙️ Голосовых в очереди: {voice_queue.size}\n"
+    for cache in caches:
+        status_text += f"📦 Кэш {cache.name}: попаданий {cache.hits}, промахов {cache.misses}\n"
+    await update.message.reply_text(status_text)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок"""
     logging.error(f"Exception while handling an update: {context.error}")
@@ -686,13 +2603,123 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception as e:
         logging.error(f"Error details: {e}", exc_info=True)
 
-async def main() -> None:
-    """Основная функция запуска бота"""
-    application = ApplicationBuilder().token(TOKEN).build()
+def shard_of(update: Update) -> int:
+    """Номер процесса-обработчика: все обновления пользователя попадают в один процесс,
+    поэтому его настройки и история в памяти не расходятся с другими процессами"""
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % BOT_WORKERS
+
+async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Передача обновления процессу-обработчику (основной процесс при BOT_WORKERS > 1)"""
+    shard = shard_of(update)
+    # При заполненной очереди put блокируется, поэтому выполняется в отдельном потоке
+    await asyncio.get_running_loop().run_in_executor(
+        None, worker_queues[shard].put, update.to_dict()
+    )
+    metrics.inc("bot_updates_forwarded_total", worker=shard)
+
+async def start_workers(application):
+    """Запуск процессов-обработчиков и общих очередей Ollama и SD"""
+    global gateway_requests, gateway_task
+    ctx = multiprocessing.get_context("spawn")
+    gateway_requests = ctx.Queue()
+    replies = [ctx.Queue() for _ in range(BOT_WORKERS)]
+    gateway_task = asyncio.ensure_future(serve_gateway(gateway_requests, replies))
+    for index in range(BOT_WORKERS):
+        queue = ctx.Queue(WORKER_QUEUE_SIZE)
+        process = ctx.Process(
+            target=run_worker,
+            args=(index, queue, gateway_requests, replies[index]),
+            name=f"bot-worker-{index}",
+        )
+        process.start()
+        worker_queues.append(queue)
+        worker_processes.append(process)
+    logging.info(f"Запущено процессов-обработчиков: {BOT_WORKERS}")
+
+async def stop_workers(application):
+    """Остановка процессов-обработчиков после обработки их очередей"""
+    loop = asyncio.get_running_loop()
+    for queue in worker_queues:
+        await loop.run_in_executor(None, queue.put, None)
+    for process in worker_processes:
+        await loop.run_in_executor(None, process.join)
+    if gateway_task:
+        gateway_requests.put(None)
+        await gateway_task
+
+def run_worker(index, queue, requests, replies):
+    """Точка входа процесса-обработчика"""
+    # Ctrl+C получает вся группа процессов, останавливает обработчики основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, queue, requests, replies))
+
+async def serve_worker(index, queue, requests, replies):
+    """Обработка обновлений, полученных от основного процесса"""
+    global worker_index, gateway, llm_scheduler
+    worker_index = index
+    gateway = llm_scheduler = GatewayClient(index, requests, replies)
+    listener = asyncio.ensure_future(gateway.listen())
+    application = build_application(api_builder().updater(None))
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    logging.info(f"Процесс-обработчик {index} готов")
+    try:
+        while (data := await loop.run_in_executor(None, queue.get)) is not None:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+        gateway.stop()
+        await listener
+
+def api_builder():
+    """ApplicationBuilder с адресом Bot API из TELEGRAM_API_URL"""
+    builder = ApplicationBuilder()
+    if TELEGRAM_API_URL:
+        url = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{url}/bot").base_file_url(f"{url}/file/bot")
+    return builder
+
+def build_front_application():
+    """Основной процесс: только принимает обновления и раздаёт их обработчикам"""
+    application = (
+        api_builder()
+        .token(TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(start_workers)
+        .post_shutdown(stop_workers)
+        .build()
+    )
+    application.add_error_handler(error_handler)
+    application.add_handler(TypeHandler(Update, forward_update))
+    return application
+
+def build_application(builder):
+    """Сборка приложения со всеми обработчиками"""
+    application = (
+        builder
+        .token(TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
     
+    # Замер времени старта (группа 1 выполняется после основных обработчиков)
+    application.add_handler(TypeHandler(Update, log_first_update), group=1)
+    
     # Регистрация обработчиков
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("switch", switch))
@@ -702,6 +2729,7 @@ async def main() -> None:
     application.add_handler(CommandHandler("cs", set_context_size))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("models", list_models))
+    application.add_handler(CommandHandler("queue", queue_status))
     application.add_handler(CommandHandler("analyze", analyze_image))
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
@@ -711,12 +2739,31 @@ async def main() -> None:
     application.add_handler(CommandHandler("d", draw))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("clearc", clear_context))
+    application.add_handler(CommandHandler("stop", stop_command))
     application.add_handler(CommandHandler("info", user_info))
     application.add_handler(CommandHandler("changename", change_name))
+    return application
+
+def main() -> None:
+    """Основная функция запуска бота"""
+    if BOT_WORKERS > 1:
+        application = build_front_application()
+    else:
+        application = build_application(api_builder())
     
     # Запуск бота
-    await application.run_polling()
+    if WEBHOOK_URL:
+        # Telegram сам присылает обновления, секретный токен проверяется в заголовке запроса
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    main()
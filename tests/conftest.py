@@ -0,0 +1,68 @@
+"""Общие настройки тестов: окружение для импорта main.py без внешних сервисов"""
+import asyncio
+import datetime
+import os
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.update(
+    TOKEN="123456:TEST",
+    PASSWORD="secret",
+    USER_DB_FILE=os.path.join(DATA_DIR, "users.db"),
+    USER_DATA_FILE=os.path.join(DATA_DIR, "users.json"),
+    CONTEXT_DB_FILE=os.path.join(DATA_DIR, "context.db"),
+    RESPONSE_CACHE_DB="",
+    SEMANTIC_CACHE="0",
+    METRICS_PORT="0",
+    BOT_WORKERS="1",
+)
+
+from telegram import Chat, Message, Update, User  # noqa: E402
+
+class FakeMessage:
+    """Сообщение пользователя, запоминающее ответы бота"""
+
+    def __init__(self, text="", user_id=7):
+        self.text = text
+        self.from_user = SimpleNamespace(id=user_id)
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+async def wait_until(condition, timeout=2.0):
+    """Ожидание условия без привязки к длительности обработчиков"""
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0)
+
+@pytest.fixture
+def make_message():
+    """Фабрика сообщений, запоминающих ответы бота"""
+    return FakeMessage
+
+@pytest.fixture
+def wait_for():
+    """Асинхронное ожидание условия: await wait_for(lambda: ...)"""
+    return wait_until
+
+@pytest.fixture
+def make_update():
+    """Фабрика обновлений с текстовым сообщением"""
+    counter = iter(range(1, 1_000_000))
+
+    def make(user_id, text="привет", chat_id=None, chat_type="private"):
+        update_id = next(counter)
+        message = Message(
+            update_id,
+            datetime.datetime.now(datetime.timezone.utc),
+            Chat(chat_id or user_id, chat_type),
+            from_user=User(user_id, f"user{user_id}", False),
+            text=text,
+        )
+        return Update(update_id, message=message)
+
+    return make
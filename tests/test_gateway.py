@@ -0,0 +1,103 @@
+"""Общие очереди Ollama и SD для нескольких процессов-обработчиков"""
+import asyncio
+import multiprocessing
+
+import pytest
+
+import main
+
+MODEL = main.MODELS["1"]
+
+@pytest.fixture
+def front(monkeypatch):
+    """Основной процесс с планировщиком на одно место и два обработчика в том же процессе"""
+    monkeypatch.setattr(main, "llm_scheduler", main.ModelScheduler(1, 1, 30, {}))
+    monkeypatch.setattr(main, "sd_semaphore", asyncio.Semaphore(1))
+    monkeypatch.setattr(main, "sd_jobs", 0)
+    ctx = multiprocessing.get_context("spawn")
+    requests = ctx.Queue()
+    replies = [ctx.Queue(), ctx.Queue()]
+    clients = [main.GatewayClient(index, requests, queue) for index, queue in enumerate(replies)]
+    return requests, replies, clients
+
+def run_with_gateway(front, scenario):
+    requests, replies, clients = front
+
+    async def wrapper():
+        server = asyncio.ensure_future(main.serve_gateway(requests, replies))
+        listeners = [asyncio.ensure_future(client.listen()) for client in clients]
+        try:
+            return await scenario(*clients)
+        finally:
+            requests.put(None)
+            await server
+            for client in clients:
+                client.stop()
+            await asyncio.gather(*listeners)
+
+    return asyncio.run(wrapper())
+
+def test_model_concurrency_is_shared_between_processes(front, wait_for):
+    async def scenario(first, second):
+        log = []
+        release = asyncio.Event()
+
+        async def ask(client, name):
+            async with client.slot(MODEL) as keep_alive:
+                log.append((name, keep_alive))
+                await release.wait()
+
+        tasks = [asyncio.ensure_future(ask(first, "first"))]
+        await wait_for(lambda: log)
+        tasks.append(asyncio.ensure_future(ask(second, "second")))
+        await wait_for(lambda: second.stats()[MODEL].get("waiting") == 1)
+        granted_before_release = list(log)
+        release.set()
+        await asyncio.gather(*tasks)
+        return granted_before_release, log
+
+    granted_before_release, log = run_with_gateway(front, scenario)
+    assert granted_before_release == [("first", "5m")]
+    assert [name for name, _ in log] == ["first", "second"]
+
+def test_cancelled_wait_frees_the_queue(front, wait_for):
+    async def scenario(first, second):
+        entered = asyncio.Event()
+        release = asyncio.Event()
+
+        async def ask(client):
+            async with client.slot(MODEL):
+                entered.set()
+                await release.wait()
+
+        holder = asyncio.ensure_future(ask(first))
+        await entered.wait()
+        waiter = asyncio.ensure_future(ask(second))
+        await wait_for(lambda: first.stats()[MODEL].get("waiting") == 1)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await wait_for(lambda: first.stats()[MODEL]["waiting"] == 0)
+        release.set()
+        await holder
+        await wait_for(lambda: first.stats()[MODEL]["running"] == 0)
+        return main.llm_scheduler.waiting[MODEL]
+
+    assert run_with_gateway(front, scenario) == []
+
+def test_sd_jobs_are_counted_across_processes(front, wait_for):
+    async def scenario(first, second):
+        release = asyncio.Event()
+
+        async def draw(client):
+            async with client.slot(main.SD_RESOURCE):
+                await release.wait()
+
+        tasks = [asyncio.ensure_future(draw(first)), asyncio.ensure_future(draw(second))]
+        await wait_for(lambda: first.sd_jobs == 2 and second.sd_jobs == 2)
+        running = main.sd_semaphore.locked()
+        release.set()
+        await asyncio.gather(*tasks)
+        await wait_for(lambda: first.sd_jobs == 0)
+        return running
+
+    assert run_with_gateway(front, scenario) is True
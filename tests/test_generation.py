@@ -0,0 +1,139 @@
+"""Остановка генерации: /stop, вытеснение новым сообщением и ограничение по времени"""
+import asyncio
+
+import pytest
+
+import main
+
+MODEL = main.MODELS["1"]
+
+class FakeOllama:
+    """Ollama, отвечающая через заданное время"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.started = 0
+
+    async def chat(self, model, messages, **kwargs):
+        self.started += 1
+        await asyncio.sleep(self.delay)
+        return {"message": {"content": f"ответ {self.started}"}}
+
+@pytest.fixture
+def ollama(monkeypatch):
+    """Ollama с ответом за 0.2 с и планировщик на одно место"""
+    client = FakeOllama(0.2)
+    monkeypatch.setattr(main, "ollama_client", client)
+    monkeypatch.setattr(main, "STREAM_REPLIES", False)
+    monkeypatch.setattr(main, "llm_scheduler", main.ModelScheduler(1, 1, 30, {}))
+    monkeypatch.setattr(main, "generations", {})
+    return client
+
+def ask(message, timeout=None):
+    return main.ask_model(message, model=MODEL, messages=[], timeout=timeout)
+
+def running():
+    return main.llm_scheduler.stats()[MODEL]["running"]
+
+def test_answer_is_sent_and_generation_forgotten(ollama, make_message):
+    message = make_message()
+    assert asyncio.run(ask(message)) == "ответ 1"
+    assert message.replies == ["ответ 1"]
+    assert main.generations == {}
+    assert not main.cancel_generation("7")
+
+def test_stop_cancels_generation_and_frees_model(ollama, make_message, wait_for):
+    async def scenario():
+        message = make_message()
+        task = asyncio.ensure_future(ask(message))
+        await wait_for(lambda: ollama.started)
+        assert main.cancel_generation("7")
+        with pytest.raises(main.GenerationCancelled):
+            await task
+        assert message.replies == []
+        assert main.generations == {}
+        assert running() == 0
+
+    asyncio.run(scenario())
+
+def test_stop_cancels_generation_waiting_for_model(ollama, make_message, wait_for):
+    async def scenario():
+        first = asyncio.ensure_future(ask(make_message(user_id=1)))
+        await wait_for(lambda: ollama.started)
+        second = asyncio.ensure_future(ask(make_message(user_id=2)))
+        await wait_for(lambda: main.llm_scheduler.stats()[MODEL]["waiting"] == 1)
+        assert main.cancel_generation("2")
+        with pytest.raises(main.GenerationCancelled):
+            await second
+        assert main.llm_scheduler.stats()[MODEL]["waiting"] == 0
+        assert await first == "ответ 1"
+        assert ollama.started == 1
+
+    asyncio.run(scenario())
+
+def test_stopping_the_handler_is_not_a_user_cancel(ollama, make_message, wait_for):
+    async def scenario():
+        task = asyncio.ensure_future(ask(make_message()))
+        await wait_for(lambda: ollama.started)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert main.generations == {}
+
+    asyncio.run(scenario())
+
+def test_new_message_supersedes_generation(ollama, make_update, make_message, wait_for):
+    async def scenario():
+        task = asyncio.ensure_future(ask(make_message()))
+        await wait_for(lambda: ollama.started)
+        main.preempt_generation(make_update(7, "/help"), "help")
+        main.preempt_generation(make_update(8, "другой пользователь"), None)
+        assert not task.done()
+        main.preempt_generation(make_update(7, "новый вопрос"), None)
+        with pytest.raises(main.GenerationCancelled):
+            await task
+
+    asyncio.run(scenario())
+
+def test_clear_supersedes_generation(ollama, make_update, make_message, wait_for):
+    async def scenario():
+        task = asyncio.ensure_future(ask(make_message()))
+        await wait_for(lambda: ollama.started)
+        main.preempt_generation(make_update(7, "/clear"), "clear")
+        with pytest.raises(main.GenerationCancelled):
+            await task
+
+    asyncio.run(scenario())
+
+def test_supersede_can_be_disabled(ollama, make_update, make_message, wait_for, monkeypatch):
+    monkeypatch.setattr(main, "SUPERSEDE_PENDING", False)
+
+    async def scenario():
+        task = asyncio.ensure_future(ask(make_message()))
+        await wait_for(lambda: ollama.started)
+        main.preempt_generation(make_update(7, "новый вопрос"), None)
+        assert await task == "ответ 1"
+
+    asyncio.run(scenario())
+
+def test_timeout_stops_generation(ollama, make_message):
+    message = make_message()
+    key = ("bot_errors_total", (("stage", "ollama_timeout"),))
+    before = main.metrics.counters.get(key, 0)
+    with pytest.raises(TimeoutError):
+        asyncio.run(ask(message, timeout=0.05))
+    assert main.metrics.counters[key] == before + 1
+    assert message.replies == []
+    assert running() == 0
+
+def test_timeout_starts_after_model_slot_is_granted(ollama, make_message, wait_for):
+    async def scenario():
+        first = asyncio.ensure_future(ask(make_message(user_id=1)))
+        await wait_for(lambda: ollama.started)
+        # Ожидание в очереди (~0.2 с) больше ограничения, сама генерация - нет
+        second = asyncio.ensure_future(ask(make_message(user_id=2), timeout=0.15))
+        ollama.delay = 0.05
+        assert await first == "ответ 1"
+        assert await second == "ответ 2"
+
+    asyncio.run(scenario())
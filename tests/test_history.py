@@ -0,0 +1,40 @@
+"""Сокращение истории диалога по числу сообщений и бюджету токенов"""
+import main
+
+def make_history(*contents):
+    history = main.new_history("системный промт")
+    for i, content in enumerate(contents):
+        history.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return history
+
+def total_tokens(history):
+    return sum(main.message_tokens(message) for message in history)
+
+def test_short_history_is_kept():
+    history = make_history("вопрос", "ответ", "ещё вопрос")
+    assert not main.trim_history(history, 21, 1000)
+    assert len(history) == 4
+
+def test_history_is_trimmed_to_target_and_starts_with_user():
+    history = make_history(*[f"сообщение {i}" for i in range(30)])
+    assert not main.trim_history(history, 21, 100_000)
+    assert history[0]["role"] == "system"
+    assert history[1]["role"] == "user"
+    assert len(history) <= int(21 * main.HISTORY_TRIM_TARGET)
+    assert history[-1]["content"] == "сообщение 29"
+
+def test_token_budget_drops_old_messages():
+    history = make_history("а" * 300, "б" * 300, "в" * 300)
+    assert not main.trim_history(history, 21, 250)
+    assert [message["content"][0] for message in history] == ["с", "в"]
+    assert total_tokens(history) <= 250
+
+def test_oversized_message_loses_its_middle():
+    text = "начало " + "х" * 30_000 + " конец"
+    history = make_history("вопрос", "ответ", text)
+    assert main.trim_history(history, 21, 6144)
+    assert len(history) == 2
+    content = history[-1]["content"]
+    assert content.startswith("начало ") and content.endswith(" конец")
+    assert main.TRUNCATION_MARK in content
+    assert total_tokens(history) <= 6144
@@ -0,0 +1,96 @@
+"""Длинные голосовые: разрезание на куски, общая очередь распознавания и прогресс"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+
+class FakeStatus:
+    """Сообщение со статусом, запоминающее правки"""
+
+    def __init__(self):
+        self.edits = []
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+
+def fake_batch(delays, failing=(), started=None):
+    """Распознавание кусков-строк: кусок «ждёт» заданное время и возвращает свой текст"""
+    def transcribe(chunks):
+        results = []
+        for chunk in chunks:
+            if started is not None:
+                started.append(chunk)
+            time.sleep(delays.get(chunk, 0.01))
+            results.append(ValueError(chunk) if chunk in failing else f" {chunk} ")
+        return results
+    return transcribe
+
+@pytest.fixture
+def chunks(monkeypatch):
+    """Подмена разрезания: куски-строки и имена потоков, в которых оно шло"""
+    split_threads = []
+    pieces = ["раз", "два", "три"]
+
+    def split_voice(voice_bytes):
+        split_threads.append(threading.current_thread().name)
+        return list(pieces)
+
+    monkeypatch.setattr(main, "split_voice", split_voice)
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0)
+    return pieces, split_threads
+
+def use_queue(monkeypatch, batch_func, workers=2, max_size=10):
+    queue = main.TranscriptionQueue(batch_func, workers, max_size, 1, 0)
+    monkeypatch.setattr(main, "voice_queue", queue)
+    return queue
+
+def test_chunks_are_joined_in_order_with_progress(chunks, monkeypatch):
+    _, split_threads = chunks
+    # Первый кусок распознаётся дольше остальных
+    queue = use_queue(monkeypatch, fake_batch({"раз": 0.2}))
+    status = FakeStatus()
+    text = asyncio.run(main.transcribe_long_voice("7", b"ogg", status))
+    assert text == "раз два три"
+    assert status.edits
+    assert all(edit.startswith("🎙️ Распознано ") for edit in status.edits)
+    assert status.edits[-1].endswith("\n… два три")
+    assert queue.size == 0 and queue.active == 0
+    # Разрезание не занимает поток распознавания
+    assert not split_threads[0].startswith("whisper")
+
+def test_long_voice_fills_only_an_empty_queue(chunks, monkeypatch):
+    queue = use_queue(monkeypatch, fake_batch({}), max_size=2)
+    assert asyncio.run(main.transcribe_long_voice("7", b"ogg", FakeStatus())) == "раз два три"
+
+    async def busy_queue():
+        # В очереди уже ждёт голосовое другого пользователя
+        queue.queues["8"] = main.deque([("чужое", asyncio.get_running_loop().create_future(), None, 0)])
+        queue.size = 1
+        await main.transcribe_long_voice("7", b"ogg", FakeStatus())
+
+    with pytest.raises(asyncio.QueueFull):
+        asyncio.run(busy_queue())
+
+def test_failed_chunk_cancels_the_rest(chunks, monkeypatch):
+    started = []
+    use_queue(monkeypatch, fake_batch({}, failing={"раз"}, started=started), workers=1)
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await main.transcribe_long_voice("7", b"ogg", FakeStatus())
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    # Ожидавшие куски отменены и не попадают в распознавание
+    assert "три" not in started
+
+def test_silent_voice_gives_empty_text(chunks, monkeypatch):
+    pieces, _ = chunks
+    pieces.clear()
+    use_queue(monkeypatch, fake_batch({}))
+    status = FakeStatus()
+    assert asyncio.run(main.transcribe_long_voice("7", b"ogg", status)) == ""
+    assert status.edits == []
@@ -0,0 +1,110 @@
+"""Ограничение частоты запросов и сброс нагрузки перед тяжёлыми запросами"""
+import asyncio
+
+import pytest
+
+import main
+
+class FakeScheduler:
+    """Планировщик Ollama с заданной статистикой очередей"""
+
+    def __init__(self, waiting, last_wait=0.0):
+        self.waiting = waiting
+        self.last_wait = last_wait
+
+    def stats(self):
+        return {"model": {"running": 1, "waiting": self.waiting, "avg_wait": 0.0, "last_wait": self.last_wait}}
+
+@pytest.fixture
+def idle(monkeypatch):
+    """Бот без нагрузки: пустые очереди Ollama, Whisper и SD, свежий лимитер"""
+    monkeypatch.setattr(main, "llm_scheduler", FakeScheduler(0))
+    monkeypatch.setattr(main, "LLM_QUEUE_LIMIT", 3)
+    monkeypatch.setattr(main, "BUSY_RETRY_AFTER", 30.0)
+    monkeypatch.setattr(main, "voice_queue", main.TranscriptionQueue(None, 1, 2, 1, 0))
+    monkeypatch.setattr(main, "gateway", None)
+    monkeypatch.setattr(main, "sd_jobs", 0)
+    monkeypatch.setattr(main, "SD_QUEUE_SIZE", 2)
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter({"text": (6, 2), "voice": (0, 0)}))
+
+def test_burst_then_refill():
+    limiter = main.RateLimiter({"text": (6, 2)})
+    assert limiter.acquire(1, "text", now=0) == 0
+    assert limiter.acquire(1, "text", now=0) == 0
+    # 6 в минуту - один токен за 10 секунд
+    assert limiter.acquire(1, "text", now=0) == pytest.approx(10)
+    assert limiter.acquire(1, "text", now=4) == pytest.approx(6)
+    assert limiter.acquire(1, "text", now=10) == 0
+    # Корзина не копит больше burst токенов
+    assert limiter.acquire(1, "text", now=1000) == 0
+    assert limiter.acquire(1, "text", now=1000) == 0
+    assert limiter.acquire(1, "text", now=1000) > 0
+
+def test_buckets_are_per_user_and_capability():
+    limiter = main.RateLimiter({"text": (6, 1), "image": (6, 1)})
+    assert limiter.acquire(1, "text", now=0) == 0
+    assert limiter.acquire(1, "text", now=0) > 0
+    assert limiter.acquire(2, "text", now=0) == 0
+    assert limiter.acquire(1, "image", now=0) == 0
+
+def test_zero_limit_disables_rate_limiting():
+    limiter = main.RateLimiter({"voice": (0, 3), "draw": (5, 0)})
+    for _ in range(10):
+        assert limiter.acquire(1, "voice", now=0) == 0
+        assert limiter.acquire(1, "draw", now=0) == 0
+    assert limiter.buckets == {}
+
+def test_prune_drops_only_full_buckets():
+    limiter = main.RateLimiter({"text": (6, 2)})
+    limiter.acquire(1, "text", now=0)
+    limiter.acquire(2, "text", now=15)
+    # К 20-й секунде корзина первого пользователя снова полна, второго - нет
+    limiter._prune(20)
+    assert list(limiter.buckets) == [(2, "text")]
+
+def test_acquire_prunes_when_buckets_overflow(monkeypatch):
+    monkeypatch.setattr(main.RateLimiter, "MAX_BUCKETS", 3)
+    limiter = main.RateLimiter({"text": (6, 2)})
+    for user_id in range(4):
+        limiter.acquire(user_id, "text", now=0)
+    assert len(limiter.buckets) == 4
+    limiter.acquire(100, "text", now=60)
+    assert list(limiter.buckets) == [(100, "text")]
+
+def test_busy_retry_after_idle(idle):
+    for capability in ("text", "image", "voice", "draw"):
+        assert main.busy_retry_after(capability) == 0
+
+def test_busy_retry_after_llm_queue(idle, monkeypatch):
+    monkeypatch.setattr(main, "llm_scheduler", FakeScheduler(3, last_wait=45.0))
+    assert main.busy_retry_after("text") == 45.0
+    assert main.busy_retry_after("image") == 45.0
+    assert main.busy_retry_after("voice") == 0
+    monkeypatch.setattr(main, "llm_scheduler", FakeScheduler(3, last_wait=5.0))
+    assert main.busy_retry_after("text") == 30.0
+    monkeypatch.setattr(main, "LLM_QUEUE_LIMIT", 0)
+    assert main.busy_retry_after("text") == 0
+
+def test_busy_retry_after_voice_and_draw(idle, monkeypatch):
+    main.voice_queue.size = 2
+    assert main.busy_retry_after("voice") == 30.0
+    monkeypatch.setattr(main, "sd_jobs", 2)
+    assert main.busy_retry_after("draw") == 30.0
+    assert main.busy_retry_after("text") == 0
+
+def test_admit_replies_when_rate_limited(idle, make_message):
+    message = make_message()
+    assert asyncio.run(main.admit(message, 1, "text"))
+    assert asyncio.run(main.admit(message, 1, "text"))
+    assert not asyncio.run(main.admit(message, 1, "text"))
+    assert message.replies == ["⏳ Слишком много запросов, повторите через 10 с"]
+
+def test_admit_replies_when_busy_without_spending_tokens(idle, make_message, monkeypatch):
+    monkeypatch.setattr(main, "llm_scheduler", FakeScheduler(5, last_wait=12.3))
+    message = make_message()
+    assert not asyncio.run(main.admit(message, 1, "text"))
+    assert message.replies == ["⏳ Бот перегружен, повторите через 30 с"]
+    assert main.rate_limiter.buckets == {}
+    monkeypatch.setattr(main, "llm_scheduler", FakeScheduler(0))
+    assert asyncio.run(main.admit(message, 1, "text"))
+    assert len(message.replies) == 1
@@ -0,0 +1,83 @@
+"""Кэш ответов по содержимому запроса: LRU в памяти и ограниченный второй уровень в SQLite"""
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+class Clock:
+    """Подменяемое time.time"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+def make_cache(path, max_size=2, disk_size=3, ttl=100):
+    return main.ResponseCache("images", max_size, path, disk_size, ttl)
+
+def disk_keys(cache):
+    return {key for key, in cache.conn.execute("SELECT key FROM images")}
+
+def test_memory_only_cache_is_lru():
+    async def scenario():
+        cache = make_cache("")
+        await cache.put("a", b"1")
+        await cache.put("b", b"2")
+        assert await cache.get("a") == b"1"
+        await cache.put("c", b"3")
+        assert await cache.get("b") is None
+        assert await cache.get("a") == b"1"
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    asyncio.run(scenario())
+
+def test_disk_keeps_only_newest_entries(clock, tmp_path):
+    async def scenario():
+        cache = make_cache(str(tmp_path / "cache.db"), max_size=1)
+        for key in "abcde":
+            clock.now += 1
+            await cache.put(key, key.encode())
+        assert disk_keys(cache) == {"c", "d", "e"}
+        # Вытесненная из памяти запись поднимается с диска
+        assert await cache.get("c") == b"c"
+        assert await cache.get("a") is None
+
+    asyncio.run(scenario())
+
+def test_expired_entries_are_skipped_and_deleted(clock, tmp_path):
+    async def scenario():
+        cache = make_cache(str(tmp_path / "cache.db"), max_size=1)
+        await cache.put("a", b"1")
+        clock.now += 60
+        await cache.put("b", b"2")
+        clock.now += 50
+        assert await cache.get("a") is None
+        await cache.put("c", b"3")
+        assert disk_keys(cache) == {"b", "c"}
+
+    asyncio.run(scenario())
+
+def test_table_without_timestamps_is_upgraded(clock, tmp_path):
+    path = str(tmp_path / "cache.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE images (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    conn.execute("INSERT INTO images VALUES ('old', x'00')")
+    conn.commit()
+    conn.close()
+
+    async def scenario():
+        cache = make_cache(path, max_size=1)
+        assert await cache.get("old") is None
+        await cache.put("new", b"1")
+        assert disk_keys(cache) == {"new"}
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+"""Семантический кэш ответов: поиск по смыслу, LRU, TTL и загрузка из SQLite"""
+import asyncio
+
+import pytest
+
+import main
+
+VECTORS = {
+    "как сварить кофе": [1.0, 0.0, 0.0],
+    "как приготовить кофе": [0.99, 0.1, 0.0],
+    "погода в москве": [0.0, 1.0, 0.0],
+    "курс доллара": [0.0, 0.0, 1.0],
+    "длинный вектор": [1.0, 0.0, 0.0, 0.0],
+}
+
+async def fake_embed(text):
+    if text not in VECTORS:
+        raise ConnectionError("нет эмбеддинга")
+    return VECTORS[text]
+
+class Clock:
+    """Подменяемое time.time"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+def make_cache(max_size=3, ttl=100, path=""):
+    return main.SemanticCache(fake_embed, max_size, ttl, 0.9, path)
+
+async def remember(cache, question, answer, scope=1):
+    cached, vector = await cache.get(scope, question)
+    assert cached is None
+    await cache.put(scope, question, vector, answer)
+
+def test_similar_question_hits_within_scope(clock):
+    async def scenario():
+        cache = make_cache()
+        await remember(cache, "как сварить кофе", "в турке")
+        answer, _ = await cache.get(1, "как приготовить кофе")
+        assert answer == "в турке"
+        assert (await cache.get(1, "погода в москве"))[0] is None
+        assert (await cache.get(2, "как сварить кофе"))[0] is None
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    asyncio.run(scenario())
+
+def test_least_recently_used_entry_is_evicted(clock):
+    async def scenario():
+        cache = make_cache(max_size=2)
+        await remember(cache, "как сварить кофе", "в турке")
+        clock.now += 1
+        await remember(cache, "погода в москве", "солнечно")
+        clock.now += 1
+        assert (await cache.get(1, "как сварить кофе"))[0] == "в турке"
+        clock.now += 1
+        await remember(cache, "курс доллара", "не знаю")
+        assert (await cache.get(1, "как сварить кофе"))[0] == "в турке"
+        assert (await cache.get(1, "погода в москве"))[0] is None
+
+    asyncio.run(scenario())
+
+def test_expired_entries_are_skipped_and_reused_first(clock):
+    async def scenario():
+        cache = make_cache(max_size=2, ttl=100)
+        await remember(cache, "как сварить кофе", "в турке")
+        clock.now += 60
+        await remember(cache, "погода в москве", "солнечно")
+        clock.now += 50
+        assert (await cache.get(1, "как сварить кофе"))[0] is None
+        # Просроченная запись освобождает место раньше давно не использованной
+        await remember(cache, "курс доллара", "не знаю")
+        assert (await cache.get(1, "погода в москве"))[0] == "солнечно"
+        assert (await cache.get(1, "курс доллара"))[0] == "не знаю"
+
+    asyncio.run(scenario())
+
+def test_same_question_replaces_answer(clock):
+    async def scenario():
+        cache = make_cache(max_size=2)
+        await remember(cache, "как сварить кофе", "в турке")
+        _, vector = await cache.get(2, "как сварить кофе")
+        await cache.put(1, "как сварить кофе", vector, "в кофеварке")
+        await remember(cache, "погода в москве", "солнечно")
+        assert (await cache.get(1, "как сварить кофе"))[0] == "в кофеварке"
+        assert (await cache.get(1, "погода в москве"))[0] == "солнечно"
+
+    asyncio.run(scenario())
+
+def test_embedding_errors_and_dimension_change(clock):
+    async def scenario():
+        cache = make_cache()
+        assert await cache.get(1, "неизвестный вопрос") == (None, None)
+        await cache.put(1, "неизвестный вопрос", None, "ответ")
+        assert cache.vectors is None
+        await remember(cache, "как сварить кофе", "в турке")
+        # Новая модель эмбеддингов: старые записи несовместимы и сбрасываются
+        await remember(cache, "длинный вектор", "ответ")
+        assert cache.vectors.shape == (3, 4)
+        assert (await cache.get(1, "длинный вектор"))[0] == "ответ"
+        assert (await cache.get(1, "как сварить кофе"))[0] is None
+
+    asyncio.run(scenario())
+
+def test_entries_are_reloaded_from_disk(clock, tmp_path):
+    path = str(tmp_path / "semantic.db")
+
+    async def fill():
+        cache = make_cache(max_size=2, ttl=100, path=path)
+        await remember(cache, "как сварить кофе", "в турке")
+        clock.now += 10
+        await remember(cache, "погода в москве", "солнечно")
+        clock.now += 70
+        await remember(cache, "курс доллара", "не знаю")
+        cache.conn.close()
+
+    async def reload():
+        cache = make_cache(max_size=2, ttl=100, path=path)
+        answers = [
+            (await cache.get(1, question))[0]
+            for question in ("как приготовить кофе", "погода в москве", "курс доллара")
+        ]
+        count = cache.conn.execute("SELECT COUNT(*) FROM semantic").fetchone()[0]
+        cache.conn.close()
+        return answers, count
+
+    asyncio.run(fill())
+    # Вытесненная запись удалена и с диска
+    assert asyncio.run(reload()) == ([None, "солнечно", "не знаю"], 2)
+    # Просроченная запись не загружается и удаляется из базы
+    clock.now += 40
+    assert asyncio.run(reload()) == ([None, None, "не знаю"], 1)
@@ -0,0 +1,116 @@
+"""Общая обёртка обработчиков: поиск пользователя, проверка авторизации, метрики"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+@pytest.fixture
+def fake_update(make_message):
+    """Фабрика обновлений-заглушек: ответы бота остаются в message.replies"""
+
+    def make(user_id, text=""):
+        return SimpleNamespace(
+            effective_user=SimpleNamespace(id=user_id), message=make_message(text, user_id)
+        )
+
+    return make
+
+@pytest.fixture
+def users(monkeypatch):
+    """Пустая память пользователей; сохранения только запоминаются"""
+    saved = []
+    monkeypatch.setattr(main, "user_data", {})
+    monkeypatch.setattr(main, "save_user_data", saved.append)
+    monkeypatch.setattr(main, "context_memory", {})
+    return saved
+
+def test_unauthenticated_user_gets_auth_reply(users, fake_update):
+    calls = []
+
+    @main.track_handler(auth="🔒 Сначала авторизуйтесь")
+    async def handler(update, context):
+        calls.append(context.user_id)
+
+    update = fake_update(7)
+    asyncio.run(handler(update, SimpleNamespace()))
+    assert calls == []
+    assert update.message.replies == ["🔒 Сначала авторизуйтесь"]
+    # Новый пользователь получил настройки по умолчанию и был сохранён
+    assert main.user_data["7"] == main.DEFAULT_USER_DATA
+    assert users == ["7"]
+
+def test_authenticated_user_reaches_handler(users, fake_update):
+    main.user_data["7"] = dict(main.DEFAULT_USER_DATA, authenticated=True)
+    calls = []
+
+    @main.track_handler(auth="🔒 Сначала авторизуйтесь")
+    async def handler(update, context):
+        calls.append((context.user_id, context.user))
+        return "ok"
+
+    update = fake_update(7)
+    assert asyncio.run(handler(update, SimpleNamespace())) == "ok"
+    assert calls == [("7", main.user_data["7"])]
+    assert update.message.replies == []
+    assert users == []
+
+def test_handler_without_auth_runs_for_anyone(users, fake_update):
+    calls = []
+
+    @main.track_handler
+    async def handler(update, context):
+        calls.append(context.user["authenticated"])
+
+    asyncio.run(handler(fake_update(7), SimpleNamespace()))
+    assert calls == [False]
+
+def test_nested_handler_reuses_user_lookup(users, fake_update, monkeypatch):
+    lookups = []
+    ensure_user_data = main.ensure_user_data
+
+    def counting(user_id):
+        lookups.append(user_id)
+        return ensure_user_data(user_id)
+
+    monkeypatch.setattr(main, "ensure_user_data", counting)
+    main.user_data["7"] = dict(main.DEFAULT_USER_DATA, authenticated=True)
+    seen = []
+
+    @main.track_handler(auth="🔒 Сначала авторизуйтесь")
+    async def inner(update, context):
+        seen.append(context.user)
+
+    @main.track_handler
+    async def outer(update, context):
+        seen.append(context.user)
+        await inner(update, context)
+
+    asyncio.run(outer(fake_update(7), SimpleNamespace()))
+    assert lookups == ["7"]
+    assert seen[0] is seen[1] is main.user_data["7"]
+
+def test_handler_errors_are_counted(users, fake_update):
+    @main.track_handler
+    async def failing_handler(update, context):
+        raise ValueError("boom")
+
+    key = ("bot_errors_total", (("stage", "failing_handler"),))
+    before = main.metrics.counters.get(key, 0)
+    with pytest.raises(ValueError):
+        asyncio.run(failing_handler(fake_update(7), SimpleNamespace()))
+    assert main.metrics.counters[key] == before + 1
+
+def test_password_flow(users, fake_update):
+    context = SimpleNamespace()
+    update = fake_update(7, "wrong")
+    asyncio.run(main.handle_message(update, context))
+    assert update.message.replies == ["❌ Неверный пароль"]
+    assert not main.user_data["7"]["authenticated"]
+
+    update = fake_update(7, main.PASSWORD)
+    asyncio.run(main.handle_message(update, SimpleNamespace()))
+    assert main.user_data["7"]["authenticated"]
+    assert main.user_data["7"]["name"] is None
+    assert update.message.replies == ["✅ Пароль принят!\n📝 Введите ваше имя:"]
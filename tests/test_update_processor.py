@@ -0,0 +1,153 @@
+"""Порядок и параллельность обработки обновлений в UserOrderedUpdateProcessor"""
+import asyncio
+
+import main
+
+def test_updates_of_one_user_run_in_order(make_update):
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(4)
+        log = []
+
+        async def handler(name, delay):
+            log.append(("start", name))
+            await asyncio.sleep(delay)
+            log.append(("end", name))
+
+        await asyncio.gather(
+            processor.process_update(make_update(1), handler("a", 0.03)),
+            processor.process_update(make_update(1), handler("b", 0.01)),
+            processor.process_update(make_update(1), handler("c", 0)),
+        )
+        return log
+
+    assert asyncio.run(scenario()) == [
+        ("start", "a"), ("end", "a"),
+        ("start", "b"), ("end", "b"),
+        ("start", "c"), ("end", "c"),
+    ]
+
+def test_same_user_in_two_chats_is_serialized(make_update, wait_for):
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(4)
+        release = asyncio.Event()
+        log = []
+
+        async def blocked():
+            log.append("group")
+            await release.wait()
+
+        async def private():
+            log.append("private")
+
+        group = asyncio.ensure_future(
+            processor.process_update(make_update(1, chat_id=-100, chat_type="group"), blocked())
+        )
+        await wait_for(lambda: log)
+        second = asyncio.ensure_future(processor.process_update(make_update(1), private()))
+        await asyncio.sleep(0.01)
+        before_release = list(log)
+        release.set()
+        await asyncio.gather(group, second)
+        return before_release, log
+
+    before_release, log = asyncio.run(scenario())
+    assert before_release == ["group"]
+    assert log == ["group", "private"]
+
+def test_queued_updates_of_one_user_do_not_block_others(make_update):
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(2)
+        release = asyncio.Event()
+        done = []
+
+        async def slow(name):
+            await release.wait()
+            done.append(name)
+
+        async def quick(name):
+            done.append(name)
+
+        busy = [
+            asyncio.ensure_future(processor.process_update(make_update(1), slow(f"a{i}")))
+            for i in range(5)
+        ]
+        await processor.process_update(make_update(2), quick("b"))
+        progress = list(done)
+        release.set()
+        await asyncio.gather(*busy)
+        return progress, done
+
+    progress, done = asyncio.run(scenario())
+    # Очередь пользователя 1 занимает один слот, второй свободен для остальных
+    assert progress == ["b"]
+    assert done == ["b", "a0", "a1", "a2", "a3", "a4"]
+
+def test_waiting_for_model_frees_the_update_slot(make_update):
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(1)
+        model_ready = asyncio.Event()
+        log = []
+
+        async def ask():
+            async with main.outside_update_slot():
+                await model_ready.wait()
+            log.append("answer")
+
+        async def help_command():
+            log.append("help")
+
+        waiting = [
+            asyncio.ensure_future(processor.process_update(make_update(user_id), ask()))
+            for user_id in (1, 2, 3)
+        ]
+        await processor.process_update(make_update(4, "/help"), help_command())
+        progress = list(log)
+        model_ready.set()
+        await asyncio.gather(*waiting)
+        return progress, log, processor.slots._value
+
+    progress, log, free_slots = asyncio.run(scenario())
+    assert progress == ["help"]
+    assert log == ["help", "answer", "answer", "answer"]
+    assert free_slots == 1
+
+def test_cancelled_handler_returns_its_slot(make_update):
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(1)
+
+        async def ask():
+            async with main.outside_update_slot():
+                await asyncio.Event().wait()
+
+        task = asyncio.ensure_future(processor.process_update(make_update(1), ask()))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return processor.slots._value, processor.locks
+
+    assert asyncio.run(scenario()) == (1, {})
+
+def test_stop_runs_while_all_slots_are_busy(make_update):
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(2)
+        release = asyncio.Event()
+        log = []
+
+        async def busy():
+            await release.wait()
+
+        async def stop():
+            log.append("stop")
+
+        handlers = [
+            asyncio.ensure_future(processor.process_update(make_update(user_id), busy()))
+            for user_id in (1, 2)
+        ]
+        await asyncio.sleep(0.01)
+        await processor.process_update(make_update(3, "/stop"), stop())
+        progress = list(log)
+        release.set()
+        await asyncio.gather(*handlers)
+        return progress
+
+    assert asyncio.run(scenario()) == ["stop"]